@@ -44,10 +44,10 @@
 # currently this doesn't actually normalize the output to probabilities, nor
 # does it format it nicely in a matrix).  In summary, these are the steps:
 #
-# input files --map--> walk_id, (hop_num, node_id)
-# walk_id, (hop_num, node_id) --reduce--> walk_id, list(hop_num, node_id)
-# walk_id, list(hop_num, node_id) --map--> (source_node, end_node), path
-# (source_node, end_node), path --reduce-->
+# input files --map--> walk_id, (list(hop_num), list(node_id))
+# walk_id, (list(hop_num), list(node_id)) --reduce--> walk_id, list(node_id)
+# walk_id, list(node_id) --map--> (source_node, end_node), (count, path)
+# (source_node, end_node), (count, path) --reduce-->
 #                                    (source_node, end_node), counter(path)
 #
 # To normalize the probabilities, we add another map and reduce:
@@ -61,21 +61,55 @@ from __future__ import division
 
 import itertools
 import logging
+import mmap
 import mrs
 import os
 import struct
-from collections import defaultdict
+from array import array
+from collections import Counter
 from StringIO import StringIO
 from subprocess import Popen, PIPE
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Use the mrs logger, so we have the same log level
 logger = logging.getLogger('mrs')
 
 walk_struct = struct.Struct('>IHI')
 walk_struct_size = walk_struct.size
+if numpy is not None:
+    # The same record layout as walk_struct, for parsing a chunk in one call.
+    walk_dtype = numpy.dtype([('walk_id', '>u4'), ('hop', '>u2'),
+        ('node', '>u4')])
+    assert walk_dtype.itemsize == walk_struct_size
 
 int32_struct = struct.Struct('=I')
 
+# The id of the edge name used for node pairs with no known relation.
+UNKNOWN_EDGE = 0
+# The maximum number of edges in a path.
+MAX_PATH_LENGTH = 5
+# The maximum number of paths to remember in a PathStringCache.
+PATH_CACHE_SIZE = 100000
+# Node names are kept in a list indexed by node id if at least this fraction
+# of the ids up to the largest one are used, and in a dict otherwise.
+MIN_NODE_ID_DENSITY = 0.5
+
+def edge_key(source, target):
+    """Pack a (source, target) node pair into a single int."""
+    return (source << 32) | target
+
+def pack_path(edge_ids):
+    """Pack a sequence of edge ids into two bytes per edge."""
+    return struct.pack('<%dH' % len(edge_ids), *edge_ids)
+
+def unpack_path(path):
+    """Unpack a path packed by pack_path into a tuple of edge ids."""
+    return struct.unpack('<%dH' % (len(path) // 2), path)
+
 def int32_bytes_dumps(pair):
     """Pack a pair consisting of an int and a bytes."""
     i, b = pair
@@ -83,30 +117,109 @@ def int32_bytes_dumps(pair):
 
 def int32_bytes_loads(x):
     """Unpack a pair consisting of an int and a bytes."""
-    i = int32_struct.unpack(x[:int32_struct.size])
+    i, = int32_struct.unpack(x[:int32_struct.size])
     b = x[int32_struct.size:]
     return i, b
 
+def hops_nodes_dumps(pair):
+    """Pack a pair consisting of a sequence of hops and a sequence of nodes of
+    the same length."""
+    hops, nodes = pair
+    n = len(hops)
+    return struct.pack('=%dH%dI' % (n, n), *(tuple(hops) + tuple(nodes)))
+
+def hops_nodes_loads(x):
+    """Unpack a pair consisting of a sequence of hops and a sequence of
+    nodes."""
+    n = len(x) // 6
+    values = struct.unpack('=%dH%dI' % (n, n), x)
+    return values[:n], values[n:]
+
+def read_columns(filename, num_columns):
+    """Read a file of lines with num_columns tab-separated fields each, and
+    return a list of the columns.
+
+    The whole file is split at once rather than line by line.
+    """
+    with open(filename) as f:
+        lines = f.read().strip().splitlines()
+    if not lines:
+        return [[] for i in range(num_columns)]
+    fields = '\t'.join(lines).split('\t')
+    if len(fields) != num_columns * len(lines):
+        raise ValueError('Expected %s tab-separated fields per line in %s'
+                % (num_columns, filename))
+    return [fields[i::num_columns] for i in range(num_columns)]
+
+def read_walk_groups(buf, start, count):
+    """Read count records from buf, starting at byte offset start, grouped
+    into walk_id, (hops, nodes) pairs."""
+    end = start + count * walk_struct_size
+    unpack_from = walk_struct.unpack_from
+    records = (unpack_from(buf, pos)
+            for pos in xrange(start, end, walk_struct_size))
+
+    groups = {}
+    for walk_id, hop, node in records:
+        try:
+            hops, nodes = groups[walk_id]
+        except KeyError:
+            hops, nodes = groups[walk_id] = (array('H'), array('I'))
+        hops.append(hop)
+        nodes.append(node)
+    return groups.iteritems()
+
+def read_walk_groups_numpy(buf, start, count):
+    """Like read_walk_groups, but parses and sorts the records with numpy."""
+    records = numpy.frombuffer(buf, dtype=walk_dtype, count=count,
+            offset=start)
+    order = numpy.argsort(records['walk_id'], kind='mergesort')
+    records = records[order]
+    walk_ids, starts = numpy.unique(records['walk_id'], return_index=True)
+    starts = starts.tolist()
+    ends = starts[1:] + [len(records)]
+    hops = records['hop'].tolist()
+    nodes = records['node'].tolist()
+    return [(walk_id, (hops[start:end], nodes[start:end]))
+            for walk_id, start, end in zip(walk_ids.tolist(), starts, ends)]
+
 
 class RandomWalkAnalyzer(mrs.MapReduce):
 
     def __init__(self, opts, args):
         super(RandomWalkAnalyzer, self).__init__(opts, args)
-        self.rel_names = {}
-        self.node_names = {}
-        for line in open(opts.rel_names_file):
-            source, target, name = line.strip().split("\t")
-            source = int(source)
-            target = int(target)
-            self.rel_names[(source, target)] = name
-            self.rel_names[(target, source)] = name + "_inv"
-        for line in open(opts.node_names_file):
-            node, name = line.strip().split("\t")
-            node = int(node)
-            # This maybe could be an array, if it's faster, but I'm not sure
-            # that we're guaranteed to have every index filled, so it would be
-            # at least slightly tricky to create the array appropriately.
-            self.node_names[node] = name
+        # Edges are referred to by small integer ids, which index into
+        # rel_strs.  The ids are looked up by edge_key(source, target).
+        self.rel_ids = {}
+        self.rel_strs = ['UNKNOWN_EDGE']
+        str_ids = {}
+        sources, targets, names = read_columns(opts.rel_names_file, 3)
+        for source, target, name in zip(map(int, sources), map(int, targets),
+                names):
+            for key, rel_str in ((edge_key(source, target), name),
+                    (edge_key(target, source), name + "_inv")):
+                rel_id = str_ids.get(rel_str)
+                if rel_id is None:
+                    rel_id = len(self.rel_strs)
+                    str_ids[rel_str] = rel_id
+                    self.rel_strs.append(rel_str)
+                self.rel_ids[key] = rel_id
+        # Edge ids are packed into two bytes each.
+        assert len(self.rel_strs) <= 2 ** 16
+        self.path_strings = PathStringCache()
+        nodes, names = read_columns(opts.node_names_file, 2)
+        nodes = map(int, nodes)
+        # We're not guaranteed to have every node id filled, so a list
+        # indexed by id (with UNKNOWN_NODE for the missing ids) is only used
+        # when the ids are dense enough for it to be smaller than a dict.
+        max_node = max(nodes or [-1])
+        if (min(nodes or [0]) >= 0 and
+                len(nodes) >= MIN_NODE_ID_DENSITY * (max_node + 1)):
+            self.node_names = ['UNKNOWN_NODE'] * (max_node + 1)
+            for node, name in zip(nodes, names):
+                self.node_names[node] = name
+        else:
+            self.node_names = dict(zip(nodes, names))
 
     def run(self, job):
         outdir = self.output_dir()
@@ -120,11 +233,20 @@ class RandomWalkAnalyzer(mrs.MapReduce):
         # and each mapper will look up the document it needs from that index.
         kv_pairs = []
         max_input_size = self.opts.input_chunk_size * 1024 ** 2
+        sizes = []
         for filename in self.args[:-1]:
             size = os.stat(filename).st_size
             assert size % walk_struct_size == 0
+            sizes.append((filename, size))
+        # Make the chunks small enough that there are at least min_map_tasks
+        # of them, so that a small input isn't left to a few slow tasks.
+        total_size = sum(size for filename, size in sizes)
+        min_chunks = max(self.opts.min_map_tasks, 1)
+        chunk_size = min(max_input_size, -(-total_size // min_chunks))
+        chunk_size = max(chunk_size, walk_struct_size)
+        for filename, size in sizes:
             total_records = size // walk_struct_size
-            chunks = (size - 1) // max_input_size + 1
+            chunks = (size - 1) // chunk_size + 1
 
             offset = 0
             for i in xrange(chunks):
@@ -146,8 +268,11 @@ class RandomWalkAnalyzer(mrs.MapReduce):
 
         # If the output of a reduce is going straight into a map, we can do a
         # reducemap, which is pretty nice.
+        # Many walks from the same node share paths, so the combiner adds up
+        # counts within each task before they go through the shuffle.
         node_pairs = job.reducemap_data(walk_ids, self.walk_id_reduce,
-                self.node_pair_map, splits=self.opts.num_count_tasks)
+                self.node_pair_map, splits=self.opts.num_count_tasks,
+                combiner=self.path_count_combine)
         walk_ids.close()
 
         path_counts = job.reducemap_data(node_pairs, self.path_count_reduce,
@@ -178,74 +303,116 @@ class RandomWalkAnalyzer(mrs.MapReduce):
 
     int32_serializer = mrs.make_primitive_serializer('=I')
     int32_pair_serializer = mrs.make_struct_serializer('=II')
+    int32_bytes_serializer = mrs.Serializer(int32_bytes_dumps,
+            int32_bytes_loads)
+
+    hops_nodes_serializer = mrs.Serializer(hops_nodes_dumps,
+            hops_nodes_loads)
 
-    @mrs.output_serializers(key=int32_serializer, value=int32_pair_serializer)
+    @mrs.output_serializers(key=int32_serializer,
+            value=hops_nodes_serializer)
     def walk_file_map(self, key, value):
-        """Input is the walk file, output is walk_id, (hop, node)"""
+        """Input is the walk file, output is walk_id, (hops, nodes).
+
+        The records in the chunk are grouped by walk_id here, so each walk
+        goes through the shuffle once per chunk instead of once per hop."""
         filename = key
         offset, count = value
         logger.info('Got walk file %s (offset %s, count %s)' %
                 (filename, offset, count))
-        walk_file = open(filename, 'rb')
-        walk_file.seek(offset * walk_struct_size)
-
-        for i in xrange(count):
-            walk_buf = walk_file.read(walk_struct_size)
-            walk_id, hop, node = walk_struct.unpack(walk_buf)
-            yield (walk_id, (hop, node))
+        if not count:
+            return []
+
+        # The mapping has to start on an allocation boundary, so it may
+        # begin up to skew bytes before the chunk.
+        start = offset * walk_struct_size
+        skew = start % mmap.ALLOCATIONGRANULARITY
+        with open(filename, 'rb') as walk_file:
+            walk_map = mmap.mmap(walk_file.fileno(),
+                    skew + count * walk_struct_size,
+                    access=mmap.ACCESS_READ, offset=start - skew)
+        try:
+            if numpy is not None:
+                return read_walk_groups_numpy(walk_map, skew, count)
+            else:
+                return read_walk_groups(walk_map, skew, count)
+        finally:
+            walk_map.close()
 
     def walk_id_reduce(self, key, values):
-        """Input is walk_id, (hop, node), from walk_file_map.  Output is
+        """Input is walk_id, (hops, nodes), from walk_file_map.  Output is
         walk_id, list(node)."""
-        value_list = list(itertools.islice(values, 100))
-        # GraphChi shouldn't ever let this happen, but sometimes there is a
-        # single walk_id with a pathologically long list of hops that really
-        # breaks things in map_walk_ids.  So we catch that case here.
-        if len(value_list) < 100:
-            value_list.sort()
-            nodes = [node for hop, node in value_list]
-            yield nodes
-
-    # Note: this program isn't Python 3 compatible anyway, so raw_serializer
-    # should be a bit faster than str_serializer.
-    #@mrs.output_serializers(key=int32_pair_serializer, value='str_serializer')
-    @mrs.output_serializers(key=int32_pair_serializer, value='raw_serializer')
+        hops = array('H')
+        nodes = array('I')
+        for chunk_hops, chunk_nodes in values:
+            hops.extend(chunk_hops)
+            nodes.extend(chunk_nodes)
+            # GraphChi shouldn't ever let this happen, but sometimes there is
+            # a single walk_id with a pathologically long list of hops that
+            # really breaks things in map_walk_ids.  So we catch that case
+            # here.
+            if len(hops) >= 100:
+                return
+        yield [node for hop, node in sorted(zip(hops, nodes))]
+
+    # Paths are packed edge ids (see pack_path), which are only expanded to
+    # edge names in matrix_map, so they go through the shuffle as raw bytes,
+    # after the count added up by path_count_combine.
+    @mrs.output_serializers(key=int32_pair_serializer,
+            value=int32_bytes_serializer)
     def node_pair_map(self, key, value):
         """Input is walk_id, list(node), from walk_id_reduce.  We then ignore
         walk_id and output (start_node, end_node), path, by going though the
         list of nodes.  We have to do some lookups to another data file to get
-        edge types between given node pairs."""
+        edge types between given node pairs.  Each path is output with a
+        count of 1, as (1, path)."""
+        # Every path starting at or after hop i uses the same edge for hop i,
+        # so each edge is looked up once per walk rather than once per path.
+        rel_get = self.rel_ids.get
+        path_strings = self.path_strings
+        edges = [rel_get(edge_key(prev_node, node), UNKNOWN_EDGE)
+                for prev_node, node in zip(value, value[1:])]
         for i, start_node in enumerate(value):
-            path = Path()
-            path.add_node(start_node)
-            prev_node = start_node
-            for node in value[i+1:]:
-                # TODO: fix the paths output here
-                edge = self.rel_names.get((prev_node, node), 'UNKNOWN_EDGE')
-                path.add_edge(edge)
-                path_str = path.get_path_string()
-                if path_str:
-                    yield ((start_node, node), path_str)
-                path.add_node(node)
-                prev_node = node
+            # Paths are built one step at a time.  A path leaves each node by
+            # way of the path to its first visit, which drops any cycle
+            # through that node, so node_paths keeps the path to (the first
+            # visit of) each node seen so far.  Paths longer than
+            # MAX_PATH_LENGTH are None, since any extension of them would be
+            # too long as well.
+            node_paths = {start_node: ()}
+            prev_path = ()
+            for edge, node in zip(edges[i:], value[i+1:]):
+                if prev_path is None or len(prev_path) >= MAX_PATH_LENGTH:
+                    path = None
+                else:
+                    path = prev_path + (edge,)
+                    yield ((start_node, node), (1, path_strings[path]))
+                prev_path = node_paths.setdefault(node, path)
+
+    def path_count_combine(self, key, values):
+        """Input and output are (start_node, end_node), (count, path), with
+        one output per distinct path.  This runs in the node_pair_map tasks,
+        so min_path_count can't be applied yet."""
+        counts = Counter()
+        for count, path in values:
+            counts[path] += count
+        for path, count in counts.iteritems():
+            yield (count, path)
 
     def path_count_reduce(self, key, values):
-        """Input is (start_node, end_node), path, from node_pair_map.  We
-        aggregate all of the paths between the two nodes into a counter and
-        output (start_node, end_node), counter(path)."""
-        counts = defaultdict(int)
-        for v in values:
-            counts[v] += 1
-        outdict = {}
-        for path, count in counts.iteritems():
-            if count >= self.opts.min_path_count:
-                outdict[path] = count
+        """Input is (start_node, end_node), (count, path), from node_pair_map
+        and path_count_combine.  We aggregate all of the paths between the two
+        nodes into a counter and output (start_node, end_node),
+        counter(path)."""
+        counts = Counter()
+        for count, path in values:
+            counts[path] += count
+        min_path_count = self.opts.min_path_count
+        outdict = dict((path, count) for path, count in counts.iteritems()
+                if count >= min_path_count)
         if outdict:
             yield outdict
 
-    int32_bytes_serializer = mrs.Serializer(int32_bytes_dumps,
-            int32_bytes_loads)
-
     @mrs.output_serializers(key=int32_bytes_serializer,
             value=int32_pair_serializer)
     def source_path_map(self, key, value):
@@ -262,22 +429,26 @@ class RandomWalkAnalyzer(mrs.MapReduce):
         output (target_node, (count, total_count, num_targets)) (the extra
         information is for consumers of these probabilities, for judging their
         reliability)."""
+        # The total is only known at the end, so we keep the counts (in flat
+        # arrays rather than a list of tuples) while adding them up.
+        targets = array('I')
+        counts = array('L')
         total_count = 0
-        # I need to iterate over values twice, so we need to make a persistent
-        # copy of it.
-        values = list(values)
         for target, count in values:
+            targets.append(target)
+            counts.append(count)
             total_count += count
         if total_count < self.opts.min_total_count:
             return
-        output = dict()
-        for target, count in values:
+        num_targets = len(targets)
+        scale = 1 / total_count
+        for target, count in itertools.izip(targets, counts):
             # In addition to saving the actually probability, we save a couple
             # of other numbers to aid the consumer of this probability in
             # judging how reliably it was estimated.  If
             # self.opts.min_total_count is high enough, this may be
             # unnecessary.
-            yield (target, (count / total_count, total_count, len(values)))
+            yield (target, (count * scale, total_count, num_targets))
 
     def matrix_map(self, key, value):
         """Input is (source_node, path), (target, (count + stuff)).  We want to
@@ -285,13 +456,25 @@ class RandomWalkAnalyzer(mrs.MapReduce):
         that it's in a nice form for easy lookups by node pair.  That's all
         this does."""
         source_node, path = key
-        source_node = self.node_names.get(source_node, 'UNKNOWN_NODE')
-        target_node, stats = value
-        target_node = self.node_names.get(target_node, 'UNKNOWN_NODE')
-        key = source_node + " " + target_node
-        value = path + " %.5f %d %d" % stats
+        path = self.path_name(path)
+        target_node, (prob, total_count, num_targets) = value
+        node_name = self.node_name
+        key = "%s %s" % (node_name(source_node), node_name(target_node))
+        value = "%s %.5f %d %d" % (path, prob, total_count, num_targets)
         yield (key, value)
 
+    def path_name(self, path):
+        """Convert a packed path into its readable form."""
+        rel_strs = self.rel_strs
+        return '-'.join([rel_strs[edge] for edge in unpack_path(path)])
+
+    def node_name(self, node):
+        """Look up the name of the given node id."""
+        try:
+            return self.node_names[node]
+        except (IndexError, KeyError):
+            return 'UNKNOWN_NODE'
+
     @classmethod
     def update_parser(cls, parser):
         parser.add_option('', '--rel-file',
@@ -337,40 +520,30 @@ class RandomWalkAnalyzer(mrs.MapReduce):
                 help='The amount of data (in MB) for each input map task',
                 default=64,
                 )
+        parser.add_option('', '--min-map-tasks',
+                dest='min_map_tasks', type=int,
+                help='Minimum number of input map tasks (e.g., the number '
+                    'of slaves), splitting the input into smaller chunks '
+                    'if needed',
+                default=1,
+                )
         return parser
 
 
-class Path(object):
-    def __init__(self):
-        # We assume here that nodes are of type int and edges are of type str;
-        # that's how we differentiate them in other parts of the code.
-        self.items = []
-
-    def add_node(self, node):
-        self.items.append(node)
-
-    def add_edge(self, edge):
-        self.items.append(edge)
-
-    def get_path_string(self, remove_cycles=True, lexicalize=False,
-            max_length=5):
-        to_output = []
-        i = len(self.items) - 1
-        while i >= 0:
-            item = self.items[i]
-            if lexicalize or not isinstance(item, int):
-                to_output.append(item)
-            if isinstance(item, int):
-                j = i - 1
-                while j >= 0:
-                    if self.items[j] == self.items[i]:
-                        i = j
-                    j -= 1
-            i -= 1
-        if len(to_output) > max_length or not to_output:
-            return None
-        to_output.reverse()
-        return '-'.join(to_output)
+class PathStringCache(dict):
+    """Maps tuples of edge ids to packed paths, packing each one only once.
+
+    The cache is emptied if it ever grows past maxsize entries.
+    """
+    def __init__(self, maxsize=PATH_CACHE_SIZE):
+        self.maxsize = maxsize
+
+    def __missing__(self, edge_ids):
+        if len(self) >= self.maxsize:
+            self.clear()
+        path_str = pack_path(edge_ids)
+        self[edge_ids] = path_str
+        return path_str
 
 
 if __name__ == '__main__':
@@ -49,7 +49,8 @@ from .main import main
 from .mapreduce import MapReduce, IterativeMR, GeneratorCallbackMR
 from .serializers import (Serializer, output_serializers, raw_serializer,
         str_serializer, int_serializer, make_struct_serializer,
-        make_primitive_serializer, make_protobuf_serializer)
+        make_primitive_serializer, make_protobuf_serializer,
+        make_msgpack_serializer)
 
 __version__ = version.__version__
 
@@ -58,6 +59,6 @@ __all__ = ['MapReduce', 'main', 'logger', 'BinWriter', 'HexWriter',
     'TextWriter', 'Serializer', 'output_serializers', 'raw_serializer',
     'str_serializer', 'int_serializer', 'make_struct_serializer',
     'make_primitive_serializer', 'make_protobuf_serializer',
-    'GeneratorCallbackMR']
+    'make_msgpack_serializer', 'GeneratorCallbackMR']
 
 # vim: et sw=4 sts=4
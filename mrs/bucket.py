@@ -15,6 +15,7 @@
 
 from __future__ import division, print_function
 
+import io
 import os
 
 from . import fileformats
@@ -28,6 +29,13 @@ except ImportError:
 from logging import getLogger
 logger = getLogger('mrs')
 
+# Buffer size for bucket output files.  This is bigger than the default to
+# cut down on write calls, but there may be one open file per split, so it
+# shouldn't be too big.
+WRITE_BUFFER_SIZE = 64 * 1024
+# Output smaller than this is held in memory until the bucket is closed.
+SPILL_THRESHOLD = WRITE_BUFFER_SIZE
+
 # Python 3 compatibility
 try:
     from cStringIO import StringIO as BytesIO
@@ -62,9 +70,7 @@ class ReadBucket(object):
         The collection can be a generator or a Mrs format.  This will block if
         the iterator blocks.
         """
-        data = self._data
-        for kvpair in pairiter:
-            data.append(kvpair)
+        self._data.extend(pairiter)
 
     def sort(self):
         self._data.sort()
@@ -131,6 +137,68 @@ class ReadBucket(object):
         return iter(self._data)
 
 
+class SpillFile(io.RawIOBase):
+    """A write-only temporary file that stays in memory until it gets big.
+
+    Writes are held in memory until they exceed the threshold, at which point
+    the file is created and the data so far are written to it.  If the
+    threshold is never reached, the file is created all at once by `commit`.
+    This avoids holding an open file for each of many small buckets.
+
+    Attributes:
+        path: The path of the file, or None if it has not been created.
+    """
+    def __init__(self, dir, prefix, suffix, threshold=SPILL_THRESHOLD):
+        super(SpillFile, self).__init__()
+        self.dir = dir
+        self.prefix = prefix
+        self.suffix = suffix
+        self.threshold = threshold
+        self.path = None
+        self._buffer = BytesIO()
+        self._file = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._file is None:
+            buf = self._buffer
+            buf.write(b)
+            if buf.tell() > self.threshold:
+                self._spill()
+        else:
+            self._file.write(b)
+        return len(b)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def _spill(self):
+        """Create the file and move the buffered data to it."""
+        self._file, self.path = util.mktempfile(self.dir, self.prefix,
+                self.suffix, WRITE_BUFFER_SIZE)
+        self._file.write(self._buffer.getvalue())
+        self._buffer = None
+
+    def commit(self, do_sync):
+        """Write all data to the file and close it.  Returns the path."""
+        if self._file is None:
+            self._spill()
+        if do_sync:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.close()
+        return self.path
+
+    def close(self):
+        # Note that closing the base class calls flush.
+        super(SpillFile, self).close()
+        if self._file is not None:
+            self._file.close()
+
+
 class WriteBucket(ReadBucket):
     """Hold data for a split.
 
@@ -171,14 +239,10 @@ class WriteBucket(ReadBucket):
         # Don't open if 1) there's no place to put it; 2) it's already saved
         # some place; or 3) it's already open.
         if self.dir and not self._filename and not self._writer:
-            # TODO: consider using SpooledTemporaryFile when self.dir is
-            # local (i.e., in /tmp).
-
             # TODO: if the directory is an hdfs url, write to a local
             # temporary file (or SpooledTemporaryFile)
             suffix='.' + self.format.ext
-            self._output_file, self._filename = util.mktempfile(self.dir,
-                    self.prefix(), suffix)
+            self._output_file = SpillFile(self.dir, self.prefix(), suffix)
             self._writer = self.format(self._output_file, self.serializers)
 
     def close_writer(self, do_sync):
@@ -187,10 +251,7 @@ class WriteBucket(ReadBucket):
             self._writer.finish()
         # TODO: If the directory is an HDFS URL, upload the file here.
         if self._output_file:
-            if do_sync:
-                self._output_file.flush()
-                os.fsync(self._output_file.fileno())
-            self._output_file.close()
+            self._filename = self._output_file.commit(do_sync)
             self._output_file = None
         # Delete the writer at the end because for some wrappers, this will
         # close the underlying file.
@@ -215,16 +276,35 @@ class WriteBucket(ReadBucket):
         if self.dir:
             if not self._writer:
                 self.open_writer()
+            # Bind the per-pair methods to locals to keep attribute lookups
+            # out of the loop.
+            writepair = self._writer.writepair
             if write_only:
                 for kvpair in pairiter:
-                    self._writer.writepair(kvpair)
+                    writepair(kvpair)
             else:
+                append = data.append
                 for kvpair in pairiter:
-                    data.append(kvpair)
-                    self._writer.writepair(kvpair)
+                    append(kvpair)
+                    writepair(kvpair)
         elif not write_only:
             data.extend(pairiter)
 
+    def collect_serialized(self, pairs, write_only=False):
+        """Collect (kvpair, serialized_key) tuples from the given list.
+
+        This is like `collect`, but each key-value pair is accompanied by its
+        already serialized key, as computed for partitioning.
+        """
+        if not write_only:
+            self._data.extend(kvpair for kvpair, _ in pairs)
+        if self.dir:
+            if not self._writer:
+                self.open_writer()
+            writepair = self._writer.writepair
+            for kvpair, serialized_key in pairs:
+                writepair(kvpair, serialized_key=serialized_key)
+
     def prefix(self):
         """Return the filename for the output split for the given index.
         """
@@ -257,6 +337,24 @@ class URLConverter(object):
             url = urlunparse(url_components)
             return url
 
+    def local_to_global_many(self, paths):
+        """Creates a list of URLs corresponding to the given paths.
+
+        Equivalent to calling `local_to_global` on each path, but the URL
+        prefix is only built once.
+        """
+        prefix = 'http://%s/' % self.netloc
+        basedir = self.basedir
+        relpath = os.path.relpath
+        urls = []
+        for path in paths:
+            url_path = relpath(path, basedir)
+            if url_path.startswith('..'):
+                urls.append(path)
+            else:
+                urls.append(prefix + url_path)
+        return urls
+
     def global_to_local(self, url, master):
         """Creates a locally accessible URL from the given URL.
 
@@ -120,6 +120,8 @@ class ComputedData(datasets.RemoteData):
     def _use_output(self, output):
         """Uses the contents of the given LocalData."""
         self._data = output._data
+        self._buckets_per_source = output._buckets_per_source
+        self._buckets_per_split = output._buckets_per_split
         self.splits = len(output._data)
         self._fetched = True
 
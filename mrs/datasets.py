@@ -19,10 +19,11 @@
 
 import collections
 import heapq
-from itertools import chain
+from itertools import chain, islice
 from operator import itemgetter
 import random
 import tempfile
+import threading
 
 from . import bucket
 from . import fileformats
@@ -30,10 +31,24 @@ from .serializers import (dumps_functions, loads_functions, raw_serializer,
         Serializers)
 from . import util
 
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
 from logging import getLogger
 logger = getLogger('mrs')
 
 DATASET_ID_LENGTH = 8
+# Number of partitioned pairs to stage before handing them to buckets.
+COLLECT_BATCH_SIZE = 65536
+# Default number of simultaneous downloads in fetchall.
+FETCH_THREADS = 8
+
+
+def local_url(url):
+    """Report whether the url refers to a local file (or to nothing)."""
+    return not url or urlparse(url, 'file').scheme == 'file'
 
 
 class BaseDataset(object):
@@ -52,9 +67,15 @@ class BaseDataset(object):
             split from all sources, use splitdata()
         serializers: a Serializers instance that keeps track of serializers
             and their associated names.
+        close_callback: function called with the dataset when it is closed.
+        computing: whether the dataset is still being computed
+        input_id: id of the dataset this one is computed from, if any
     """
+    computing = False
+    input_id = None
+
     def __init__(self, splits=0, dir=None, format=None, permanent=True,
-            serializers=None):
+            serializers=None, close_callback=None):
         self.splits = splits
         self.dir = dir
         self.format = format
@@ -63,12 +84,14 @@ class BaseDataset(object):
 
         self.id = util.random_string(DATASET_ID_LENGTH)
         self.closed = False
-        self._close_callback = None
+        self._close_callback = close_callback
         self._extended_sources = 0
 
+        # Buckets are indexed by (source, split) and by each dimension
+        # separately so that slices can be returned without any lookups.
         self._data = {}
-        self._splits_per_source = collections.defaultdict(set)
-        self._sources_per_split = collections.defaultdict(set)
+        self._buckets_per_source = collections.defaultdict(dict)
+        self._buckets_per_split = collections.defaultdict(dict)
 
     def _make_bucket(self, source, split):
         """Overridable method for creating a new bucket."""
@@ -143,6 +166,8 @@ class BaseDataset(object):
 
     def clear(self):
         self._data = None
+        self._buckets_per_source = None
+        self._buckets_per_split = None
 
     def delete(self):
         """Delete current data and temporary files from the dataset."""
@@ -172,14 +197,21 @@ class BaseDataset(object):
     def __setitem__(self, key, bucket):
         self._data[key] = bucket
         source, split = key
-        self._splits_per_source[source].add(split)
-        self._sources_per_split[split].add(source)
+        self._buckets_per_source[source][split] = bucket
+        self._buckets_per_split[split][source] = bucket
 
     def __getitem__(self, key_pair):
         """Retrieve a bucket or iterator, given a (source_key, split_key) pair.
 
         Returns an iterator over buckets if either key is a slice.
         """
+        # Fast path for the most common case: an existing bucket.  Slices are
+        # unhashable (or at least absent), so they fall through.
+        try:
+            return self._data[key_pair]
+        except (KeyError, TypeError):
+            pass
+
         # Separate the two dimensions:
         try:
             source_key, split_key = key_pair
@@ -190,12 +222,9 @@ class BaseDataset(object):
         split_key_is_slice = isinstance(split_key, slice)
 
         if not source_key_is_slice and not split_key_is_slice:
-            # Special case: single bucket
-            try:
-                bucket = self._data[key_pair]
-            except KeyError:
-                bucket = self._make_bucket(source_key, split_key)
-                self[key_pair] = bucket
+            # Special case: single bucket, which the fast path did not find.
+            bucket = self._make_bucket(source_key, split_key)
+            self[key_pair] = bucket
             return bucket
 
         if ((source_key_is_slice and (source_key.start != None or
@@ -204,22 +233,20 @@ class BaseDataset(object):
                 split_key.stop != None or  split_key.step != None))):
             raise TypeError("General slicing is not supported")
 
-        data = self._data
-
         if source_key_is_slice and split_key_is_slice:
-            return data.values()
+            return self._data.values()
         elif split_key_is_slice:
-            splits = self._splits_per_source.get(source_key)
-            if splits is None:
+            buckets = self._buckets_per_source.get(source_key)
+            if buckets is None:
                 return iter(())
             else:
-                return (data[source_key, y] for y in splits)
+                return buckets.values()
         elif source_key_is_slice:
-            sources = self._sources_per_split.get(split_key)
-            if sources is None:
+            buckets = self._buckets_per_split.get(split_key)
+            if buckets is None:
                 return iter(())
             else:
-                return (data[x, split_key] for x in sources)
+                return buckets.values()
 
     # The __iter__ method must be defined because the default iterator falls
     # back on __getitem__ and goes horribly wrong.
@@ -233,6 +260,7 @@ class BaseDataset(object):
     def __getstate__(self):
         """Pickle without getting certain forbidden/unnecessary elements."""
         state = self.__dict__.copy()
+        state['_close_callback'] = None
         serializers = self.serializers
         if serializers is not None:
             state['serializers'] = (serializers.key_s_name,
@@ -260,8 +288,10 @@ class LocalData(BaseDataset):
     [(7, 'to_3')]
     >>>
     """
+    _unfetched = False
+
     def __init__(self, itr, splits=None, source=0, parter=None,
-            write_only=False, **kwds):
+            write_only=False, url_converter=None, **kwds):
         if parter is not None and splits is None:
             raise RuntimeError('The splits parameter is required when parter'
                     ' is specified.')
@@ -272,10 +302,52 @@ class LocalData(BaseDataset):
 
         self.collected = False
         self._collect(itr, parter, write_only)
-        for key, bucket in self._data.items():
-            self._data[key] = bucket.readonly_copy()
+        copies = [(key, b.readonly_copy()) for key, b in self._data.items()]
+        if url_converter is not None:
+            written = [b for _, b in copies if b.url]
+            urls = url_converter.local_to_global_many(
+                    [b.url for b in written])
+            for b, url in zip(written, urls):
+                b.url = url
+        for key, b in copies:
+            self[key] = b
         self.collected = True
 
+    def __getstate__(self):
+        """Pickle without the data of buckets that can be read by url.
+
+        The implementation only needs the urls of buckets that were written
+        out, so their in-memory data stays behind in the job process.  A
+        runner that reads the unpickled dataset directly (as the serial
+        runner does) must call fetchall to load them back from their urls.
+        """
+        state = super(LocalData, self).__getstate__()
+        if any(b.url and len(b) for b in self._data.values()):
+            state['_unfetched'] = True
+            data = {}
+            per_source = collections.defaultdict(dict)
+            per_split = collections.defaultdict(dict)
+            for (source, split), b in self._data.items():
+                if b.url and len(b):
+                    url = b.url
+                    b = bucket.ReadBucket(source, split, b.serializers)
+                    b.url = url
+                data[source, split] = b
+                per_source[source][split] = b
+                per_split[split][source] = b
+            state['_data'] = data
+            state['_buckets_per_source'] = per_source
+            state['_buckets_per_split'] = per_split
+        return state
+
+    def fetchall(self, *args, **kwds):
+        """Load the buckets whose data was left out when pickling."""
+        if self._unfetched:
+            for b in self[:, :]:
+                if b.url and not len(b):
+                    b.collect(b.stream(self.serializers))
+            self._unfetched = False
+
     def _make_bucket(self, source, split):
         assert not self.collected
         assert source == self.fixed_source
@@ -304,20 +376,54 @@ class LocalData(BaseDataset):
                 bucket.collect(itr, write_only)
             else:
                 dumps_key, _ = dumps_functions(self.serializers)
-                for kvpair in itr:
-                    key, value = kvpair
+                # Work on a batch of pairs at a time so that serializing and
+                # partitioning run through map() rather than an interpreted
+                # per-pair loop.  Each batch is staged by split and then each
+                # split's run is handed to its bucket at once, rather than
+                # interleaving writes across all of the buckets.
+                # A partition function may advertise that it is just
+                # `partition_key(key) % n` so that we can skip calling it.
+                partition_key = getattr(parter, 'partition_key', None)
+                buckets = {}
+                staged = collections.defaultdict(list)
+                itr = iter(itr)
+                while True:
+                    batch = list(islice(itr, COLLECT_BATCH_SIZE))
+                    if not batch:
+                        break
+                    keys = [key for key, value in batch]
                     if dumps_key is None:
-                        serialized_key = key
+                        serialized_keys = keys
                     else:
-                        serialized_key = dumps_key(key)
-                    split = parter(key, serialized_key, n)
-                    bucket = self[source, split]
-                    bucket.addpair(kvpair, write_only,
-                            serialized_key=serialized_key)
+                        serialized_keys = list(map(dumps_key, keys))
+                    if partition_key is None:
+                        splits = map(parter, keys, serialized_keys,
+                                [n] * len(keys))
+                    else:
+                        splits = [x % n for x in map(partition_key, keys)]
+                    for split, kvpair, serialized_key in zip(splits, batch,
+                            serialized_keys):
+                        staged[split].append((kvpair, serialized_key))
+                    self._flush_staged(staged, buckets, write_only)
         for bucket in self[:, :]:
             bucket.close_writer(self.permanent)
 
 
+    def _flush_staged(self, staged, buckets, write_only):
+        """Send staged (kvpair, serialized_key) runs to their buckets.
+
+        The `buckets` dict caches buckets by split across calls.
+        """
+        source = self.fixed_source
+        for split, pairs in staged.items():
+            try:
+                bucket = buckets[split]
+            except KeyError:
+                bucket = buckets[split] = self[source, split]
+            bucket.collect_serialized(pairs, write_only)
+        staged.clear()
+
+
 class RemoteData(BaseDataset):
     """A Dataset whose contents can be downloaded and read.
 
@@ -339,6 +445,8 @@ class RemoteData(BaseDataset):
         del state['_fetched']
         if self.closed:
             state['_data'] = None
+            state['_buckets_per_source'] = None
+            state['_buckets_per_split'] = None
         return state
 
     def __setstate__(self, dict):
@@ -346,9 +454,12 @@ class RemoteData(BaseDataset):
         self._close_callback = None
         self._fetched = False
 
-    # TODO: consider parallelizing this to use multiple downloading threads.
-    def fetchall(self, _called_in_runner=False):
-        """Download all of the files."""
+    def fetchall(self, _called_in_runner=False, max_concurrent=FETCH_THREADS):
+        """Download all of the files.
+
+        Up to `max_concurrent` buckets are downloaded at a time, each in its
+        own thread.
+        """
 
         # Don't call fetchall twice.
         if self._fetched:
@@ -366,15 +477,57 @@ class RemoteData(BaseDataset):
         # tasks hitting the same machines at the same time.
         buckets = [bucket for bucket in self[:, :] if bucket.url]
         random.shuffle(buckets)
-        for bucket in buckets:
-            with fileformats.open_url(bucket.url, **kwds) as reader:
-                bucket.collect(reader)
+        nthreads = min(max_concurrent, len(buckets))
+        if nthreads > 1:
+            self._fetch_parallel(buckets, nthreads, kwds)
+        else:
+            for bucket in buckets:
+                self._fetch_bucket(bucket, kwds)
 
         self._fetched = True
 
+    def _fetch_bucket(self, bucket, kwds):
+        with fileformats.open_url(bucket.url, **kwds) as reader:
+            bucket.collect(reader)
+
+    def _fetch_parallel(self, buckets, nthreads, kwds):
+        """Download the given buckets using several threads.
+
+        Since each bucket is collected by only one thread, no locking is
+        needed beyond the (atomic) popleft from the shared deque.  The first
+        error encountered is reraised after all of the threads finish.
+        """
+        remaining = collections.deque(buckets)
+        errors = []
+
+        def fetch_loop():
+            while not errors:
+                try:
+                    bucket = remaining.popleft()
+                except IndexError:
+                    return
+                try:
+                    self._fetch_bucket(bucket, kwds)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=fetch_loop)
+                for _ in range(nthreads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def _stream_buckets(self, buckets, serializers):
         streams = (b.stream(serializers) for b in buckets)
-        return chain.from_iterable(streams)
+        data = chain.from_iterable(streams)
+        if any(not local_url(b.url) for b in buckets):
+            # Overlap downloading with processing of the data.
+            data = util.prefetch(data)
+        return data
 
     def stream_data(self, serializers=None, _called_in_runner=False):
         """Iterate over all remote key-value pairs in the dataset."""
@@ -404,12 +557,15 @@ class MergeSortData(BaseDataset):
     """A locally stored copy, sorted by key, of another dataset.
 
     If the dataset is small enough, it will be stored in RAM.  Otherwise,
-    it will be stored in local temporary files.
+    it will be stored in local temporary files, in a directory that is only
+    created (within `tmpdir_parent`) once the data are too big for RAM.
 
     Note that this class is very specific in its purpose and applicability.
+    In particular, data held in RAM can only be streamed once.
     """
     def __init__(self, input, input_split, max_sort_size, splits=None,
-            source=None, parter=None, _called_in_runner=False, **kwds):
+            source=None, parter=None, tmpdir_parent=None,
+            _called_in_runner=False, **kwds):
         if parter is not None:
             raise RuntimeError('The parter paramater must not be specified')
         if source is not None:
@@ -422,6 +578,9 @@ class MergeSortData(BaseDataset):
         self.fixed_split = input_split
         self.serializers = input.serializers
         self.permanent = False
+        self._tmpdir_parent = tmpdir_parent
+        # Sorted data (and deserializers) if everything fit in RAM.
+        self._ram_data = None
 
         self.collected = False
         self._collect(input, input_split, max_sort_size, _called_in_runner)
@@ -459,12 +618,11 @@ class MergeSortData(BaseDataset):
             data_list.sort(key=itemgetter(0))
             self._flush_data(data_list, raw_serializers, input.serializers)
         else:
+            # Rather than copying the sorted pairs into a bucket (a second
+            # full pass and a second copy in memory), keep the sorted list and
+            # deserialize from it as it is streamed.
             data_list.sort(key=itemgetter(0))
-            b = bucket.WriteBucket(0, self.fixed_split)
-            data_itr = self._iter_deserialized(data_list, loads_key,
-                    loads_value)
-            b.collect(data_itr)
-            self._append_bucket(b)
+            self._ram_data = (data_list, loads_key, loads_value)
 
         logger.debug('MergeSortData initialized %s bytes in %s buckets'
                 % (total_bytes, len(self._data)))
@@ -490,6 +648,8 @@ class MergeSortData(BaseDataset):
     def _flush_data(self, data_list, serializers, input_serializers):
         if not data_list:
             return
+        if not self.dir and self._tmpdir_parent:
+            self.dir = util.mktempdir(self._tmpdir_parent, self.id + '_')
         b = bucket.WriteBucket(len(self._data), self.fixed_split,
                 self.dir, serializers=serializers)
         loads_key, _ = loads_functions(input_serializers)
@@ -502,13 +662,27 @@ class MergeSortData(BaseDataset):
 
     def _append_bucket(self, b):
         b = b.readonly_copy()
-        self._data[b.source, b.split] = b
+        self[b.source, b.split] = b
 
     def stream_data(self, serializers=None, _called_in_runner=False):
         """Iterate over data from all buckets in key-sorted order."""
+        if self._ram_data is not None:
+            # The sorted list is only needed once, so release each pair as
+            # soon as it has been used.
+            data_list, loads_key, loads_value = self._ram_data
+            self._ram_data = None
+            return iter(self._iter_deserialized(util.drain(data_list),
+                loads_key, loads_value))
         streams = [b.stream(serializers) for b in self[:, :]]
+        if len(streams) == 1:
+            # With a single sorted run, there are no runs to merge.
+            return streams[0]
         return heapq.merge(*streams)
 
+    def clear(self):
+        super(MergeSortData, self).clear()
+        self._ram_data = None
+
 
 class FileData(RemoteData):
     """A list of static files or urls to be used as input to an operation.
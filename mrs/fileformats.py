@@ -15,9 +15,9 @@
 
 from __future__ import division, print_function
 
-import codecs
+from binascii import hexlify, unhexlify
 import gzip
-from itertools import islice
+import mmap
 import os
 import struct
 import sys
@@ -37,12 +37,11 @@ from .serializers import dumps_functions, loads_functions
 
 
 DEFAULT_BUFFER_SIZE = 4096
+# Binary records are collected in a buffer of this size before being written.
+RECORD_BUFFER_SIZE = 64 * 1024
 # 1 is fast and unaggressive, 9 is slow and aggressive
 COMPRESS_LEVEL = 9
 
-hex_encoder = codecs.getencoder('hex_codec')
-hex_decoder = codecs.getdecoder('hex_codec')
-
 len_struct = struct.Struct('<I')
 
 
@@ -198,8 +197,8 @@ class HexReader(Reader):
         """Iterate over key-value pairs."""
         for line in self.fileobj:
             encoded_key, encoded_value = line.split()
-            key, _ = hex_decoder(encoded_key)
-            value, _ = hex_decoder(encoded_value)
+            key = unhexlify(encoded_key)
+            value = unhexlify(encoded_value)
             if self.loads_key is not None:
                 key = self.loads_key(key)
             if self.loads_value is not None:
@@ -212,9 +211,15 @@ class HexWriter(Writer):
 
     Initialize with a file-like object.  The ASCII hexadecimal encoding of
     keys has the property that sorting the file will preserve the sort order.
+    As with BinWriter, lines are collected in a buffer, so the file is only
+    up to date after `finish` is called.
     """
     ext = 'mrsx'
 
+    def __init__(self, fileobj, *args, **kwds):
+        super(HexWriter, self).__init__(fileobj, *args, **kwds)
+        self._buffer = bytearray()
+
     def writepair(self, kvpair, serialized_key=None):
         """Write a key-value pair."""
         key, value = kvpair
@@ -224,18 +229,31 @@ class HexWriter(Writer):
             key = self.dumps_key(key)
         if self.dumps_value is not None:
             value = self.dumps_value(value)
-        encoded_key, length = hex_encoder(key)
-        encoded_value, length = hex_encoder(value)
-        write = self.fileobj.write
-        write(encoded_key)
-        write(b' ')
-        write(encoded_value)
-        write(b'\n')
+        buf = self._buffer
+        buf += hexlify(key)
+        buf += b' '
+        buf += hexlify(value)
+        buf += b'\n'
+        if len(buf) >= RECORD_BUFFER_SIZE:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer:
+            # Some file objects (e.g., gzip in Python 2) reject bytearrays.
+            self.fileobj.write(bytes(self._buffer))
+            del self._buffer[:]
+
+    def finish(self):
+        self._write_buffer()
+        super(HexWriter, self).finish()
 
 
 class BinWriter(Writer):
     """A key-value store using a simple binary record format.
 
+    Records are collected in a reusable buffer and written to the file in
+    large pieces, so the file is only up to date after `finish` is called.
+
     By default, the given file will be closed when the writer is closed,
     but the close argument makes this configurable.  Setting close to False
     is useful for StringIO/BytesIO.
@@ -246,6 +264,7 @@ class BinWriter(Writer):
     def __init__(self, fileobj, *args, **kwds):
         super(BinWriter, self).__init__(fileobj, *args, **kwds)
         self.fileobj.write(self.magic)
+        self._buffer = bytearray()
 
     def writepair(self, kvpair, serialized_key=None):
         """Write a key-value pair."""
@@ -256,31 +275,52 @@ class BinWriter(Writer):
             key = self.dumps_key(key)
         if self.dumps_value is not None:
             value = self.dumps_value(value)
-        write = self.fileobj.write
-
-        binlen = len_struct.pack(len(key))
-        write(binlen)
-        write(key)
+        pack = len_struct.pack
+        buf = self._buffer
+        buf += pack(len(key))
+        buf += key
+        buf += pack(len(value))
+        buf += value
+        if len(buf) >= RECORD_BUFFER_SIZE:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer:
+            # Some file objects (e.g., gzip in Python 2) reject bytearrays.
+            self.fileobj.write(bytes(self._buffer))
+            del self._buffer[:]
 
-        binlen = len_struct.pack(len(value))
-        write(binlen)
-        write(value)
+    def finish(self):
+        self._write_buffer()
+        super(BinWriter, self).finish()
 
 
 class BinReader(Reader):
-    """A key-value store using a simple binary record format."""
+    """A key-value store using a simple binary record format.
+
+    If the file object is an mmap, records are sliced directly out of the
+    mapped file rather than being read into a buffer.
+    """
     magic = b'MrsB'
 
     def __init__(self, fileobj, *args, **kwds):
         super(BinReader, self).__init__(fileobj, *args, **kwds)
-        self._buffer = b''
+        self._mapped = isinstance(fileobj, mmap.mmap)
+        if self._mapped:
+            self._buffer = fileobj
+        else:
+            self._buffer = b''
+        self._pos = 0
         self._magic_read = False
 
     def __iter__(self):
         """Iterate over key-value pairs."""
-        #TODO: check for 'MRSB' magic cookie
         if not self._magic_read:
-            buf = self.fileobj.read(len(self.magic))
+            if self._mapped:
+                buf = self._buffer[:len(self.magic)]
+                self._pos = len(buf)
+            else:
+                buf = self.fileobj.read(len(self.magic))
             if buf != self.magic:
                 raise RuntimeError('Invalid file header: "%s"'
                     % buf.encode('hex_codec'))
@@ -300,27 +340,37 @@ class BinReader(Reader):
             yield (key, value)
 
     def _fill_buffer(self, size=DEFAULT_BUFFER_SIZE):
-        self._buffer += self.fileobj.read(size)
+        """Read more data, discarding the part of the buffer already used."""
+        if self._mapped:
+            # The whole file is already in the buffer.
+            return
+        self._buffer = self._buffer[self._pos:] + self.fileobj.read(size)
+        self._pos = 0
 
     def _read_record(self):
-        if len(self._buffer) < len_struct.size:
+        # Rather than slicing off each record as it is read (which copies the
+        # rest of the buffer), keep track of the current position.
+        if self._pos + len_struct.size > len(self._buffer):
             self._fill_buffer()
-        if not self._buffer:
+        buf = self._buffer
+        pos = self._pos
+        if pos == len(buf):
             return None
 
-        lenfield = self._buffer[:len_struct.size]
-        length, = len_struct.unpack(lenfield)
-
-        end = len_struct.size + length
-        if end > len(self._buffer):
-            self._fill_buffer(end - len(self._buffer))
+        length, = len_struct.unpack_from(buf, pos)
 
-        if end > len(self._buffer):
-            raise RuntimeError('File ended unexpectedly')
+        start = pos + len_struct.size
+        end = start + length
+        if end > len(buf):
+            self._fill_buffer(end - len(buf) + DEFAULT_BUFFER_SIZE)
+            buf = self._buffer
+            start -= pos
+            end -= pos
+            if end > len(buf):
+                raise RuntimeError('File ended unexpectedly')
 
-        data = self._buffer[len_struct.size:end]
-        self._buffer = self._buffer[end:]
-        return data
+        self._pos = end
+        return buf[start:end]
 
 
 class ZipWriter(BinWriter):
@@ -339,6 +389,7 @@ class ZipWriter(BinWriter):
         super(ZipWriter, self).__init__(fileobj, *args, **kwds)
 
     def finish(self):
+        self._write_buffer()
         # Close the gzip file (which does not close the underlying file).
         self.fileobj.close()
 
@@ -371,6 +422,21 @@ def fileformat(filename):
     return reader_map.get(extension, default_read_format)
 
 
+def map_file(f):
+    """Returns a read-only mmap of the given file, which is then closed.
+
+    If the file cannot be mapped (for example, if it is empty), the original
+    file object is returned instead.
+    """
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return f
+    # The mmap keeps its own reference to the file.
+    f.close()
+    return mapped
+
+
 def open_url(url, **kwds):
     """Opens a url or file and returns an appropriate key-value reader."""
     reader_cls = fileformat(url)
@@ -378,6 +444,8 @@ def open_url(url, **kwds):
     parsed_url = urlparse(url, 'file')
     if parsed_url.scheme == 'file':
         f = open(parsed_url.path, 'rb')
+        if reader_cls is BinReader:
+            f = map_file(f)
     else:
         if parsed_url.scheme == 'hdfs':
             server, username, path = hdfs.urlsplit(url)
@@ -26,6 +26,10 @@ PROCESS_REQUESTS_THREADS = 20
 # Connection Refused if its backlog is full).
 RETRIES = 10
 RETRY_DELAY = 5
+# Seconds between checks for a shutdown request in serve_forever.  Requests
+# are handled as soon as they arrive, and the servers are never shut down
+# explicitly, so this only limits idle wakeups.
+SERVE_POLL_INTERVAL = 60
 
 import errno
 import os
@@ -171,6 +175,10 @@ class RPCRequestHandler(SimpleXMLRPCRequestHandler):
     # Disabling Nagle's Algorithm happens for XMLRPC by default in Python
     # version 2.7 and 3.2.
     disable_nagle_algorithm = True
+    # Buffer each reply so that the status line, headers, and body go out in
+    # a single send (and a single packet, since Nagle is disabled) when the
+    # request is finished rather than in separate small writes.
+    wbufsize = -1
     if not hasattr(SimpleHTTPRequestHandler, 'disable_nagle_algorithm'):
         def setup(self):
             SimpleHTTPRequestHandler.setup(self)
@@ -207,6 +215,9 @@ class RPCServer(SimpleXMLRPCServer):
                 requestHandler=RPCRequestHandler, logRequests=False)
         self.instance = instance
 
+    def serve_forever(self, poll_interval=SERVE_POLL_INTERVAL):
+        SimpleXMLRPCServer.serve_forever(self, poll_interval)
+
     def _dispatch(self, method, params, host):
         try:
             func = getattr(self.instance, 'xmlrpc_' + method)
@@ -303,6 +314,20 @@ class BucketRequestHandler(SimpleHTTPRequestHandler):
 
         return os.path.join(self.server.basedir, *words)
 
+    def copyfile(self, source, outputfile):
+        """Send the bucket file, without copying it through user space.
+
+        Python 3.5 and later provide socket.sendfile, which uses the
+        sendfile system call where available (and falls back to send).
+        """
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if sendfile is None:
+            SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        else:
+            # The status line and headers are still in the write buffer.
+            outputfile.flush()
+            sendfile(source)
+
     def log_request(self, *args, **kwds):
         return
 
@@ -319,6 +344,9 @@ class BucketServer(socketserver.TCPServer):
         socketserver.TCPServer.__init__(self, addr, BucketRequestHandler)
         self.basedir = basedir
 
+    def serve_forever(self, poll_interval=SERVE_POLL_INTERVAL):
+        socketserver.TCPServer.serve_forever(self, poll_interval)
+
 
 class ThreadingBucketServer(ThreadPoolMixIn, BucketServer):
     pass
@@ -15,6 +15,7 @@
 
 from __future__ import division, print_function
 
+import contextlib
 import multiprocessing
 import os
 import select
@@ -32,6 +33,12 @@ from .serializers import Serializers
 from . import tasks
 from . import util
 
+try:
+    import selectors
+except ImportError:
+    # Python 2
+    selectors = None
+
 from logging import getLogger
 logger = getLogger('mrs')
 
@@ -54,6 +61,8 @@ class Job(object):
         self.default_partition = program.partition
         self.default_reduce_tasks = getattr(opts, 'mrs__reduce_tasks', 1)
         self.default_reduce_splits = 1
+        # Output directories already known to exist.
+        self._outdirs = set()
 
     def wait(self, *datasets, **kwds):
         """Wait for any of the given Datasets to complete.
@@ -64,11 +73,30 @@ class Job(object):
         """
         return self._manager.wait(*datasets, **kwds)
 
+    @contextlib.contextmanager
+    def batched(self):
+        """Submit all datasets defined in the with block in one message.
+
+        This lets the implementation see several dependent datasets at once:
+
+            with job.batched():
+                intermediate = job.map_data(source, self.map)
+                output = job.reduce_data(intermediate, self.reduce)
+
+        Held datasets are also sent early if a dataset is closed or waited
+        on within the block.
+        """
+        self._manager.begin_batch()
+        try:
+            yield
+        finally:
+            self._manager.flush_batch()
+
     def file_data(self, filenames):
         """Defines a set of data from a list of urls."""
-        ds = datasets.FileData(filenames)
+        ds = datasets.FileData(filenames,
+                close_callback=self._manager.close_dataset)
         self._manager.submit(ds)
-        ds._close_callback = self._manager.close_dataset
         return ds
 
     def local_data(self, itr, splits=None, outdir=None, parter=None, **kwds):
@@ -90,16 +118,13 @@ class Job(object):
                 outdir = util.mktempdir(self._default_dir, 'output_')
                 permanent = self._keep_jobdir
         if outdir:
-            util.try_makedirs(outdir)
+            self._ensure_outdir(outdir)
 
         self._set_serializers(None, kwds)
         ds = datasets.LocalData(itr, splits, dir=outdir, parter=parter,
-                permanent=permanent, **kwds)
-        if self._url_converter:
-            for bucket in ds[:, :]:
-                bucket.url = self._url_converter.local_to_global(bucket.url)
+                permanent=permanent, url_converter=self._url_converter,
+                close_callback=self._manager.close_dataset, **kwds)
         self._manager.submit(ds)
-        ds._close_callback = self._manager.close_dataset
         return ds
 
     def map_data(self, input, mapper, splits=None, outdir=None, combiner=None,
@@ -117,7 +142,7 @@ class Job(object):
 
         if outdir:
             permanent = True
-            util.try_makedirs(outdir)
+            self._ensure_outdir(outdir)
         else:
             permanent = False
 
@@ -134,9 +159,9 @@ class Job(object):
 
         op = tasks.MapOperation(map_name, combine_name, part_name)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
-                permanent=permanent, **kwds)
+                permanent=permanent,
+                close_callback=self._manager.close_dataset, **kwds)
         self._manager.submit(ds)
-        ds._close_callback = self._manager.close_dataset
         return ds
 
     def reduce_data(self, input, reducer, splits=None, outdir=None,
@@ -153,7 +178,7 @@ class Job(object):
 
         if outdir:
             permanent = True
-            util.try_makedirs(outdir)
+            self._ensure_outdir(outdir)
         else:
             permanent = False
 
@@ -166,9 +191,9 @@ class Job(object):
 
         op = tasks.ReduceOperation(reduce_name, part_name)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
-                permanent=permanent, **kwds)
+                permanent=permanent,
+                close_callback=self._manager.close_dataset, **kwds)
         self._manager.submit(ds)
-        ds._close_callback = self._manager.close_dataset
         return ds
 
     def reducemap_data(self, input, reducer, mapper, splits=None, outdir=None,
@@ -182,7 +207,7 @@ class Job(object):
 
         if outdir:
             permanent = True
-            util.try_makedirs(outdir)
+            self._ensure_outdir(outdir)
         else:
             permanent = False
 
@@ -201,9 +226,9 @@ class Job(object):
         op = tasks.ReduceMapOperation(reduce_name, map_name, combine_name,
                 part_name)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
-                permanent=permanent, **kwds)
+                permanent=permanent,
+                close_callback=self._manager.close_dataset, **kwds)
         self._manager.submit(ds)
-        ds._close_callback = self._manager.close_dataset
         return ds
 
     def progress(self, dataset):
@@ -252,6 +277,12 @@ class Job(object):
         serializers = Serializers(key_s, key_s_name, value_s, value_s_name)
         kwds['serializers'] = serializers
 
+    def _ensure_outdir(self, outdir):
+        """Create the given output directory unless it is known to exist."""
+        if outdir not in self._outdirs:
+            util.try_makedirs(outdir)
+            self._outdirs.add(outdir)
+
     def _named_attr(self, value):
         if isinstance(value, str):
             return value, getattr(self._program, value)
@@ -329,71 +360,117 @@ class DataManager(object):
 
     def __init__(self, pipe, quit_pipe):
         self._pipe = pipe
+        self._pipe_fd = pipe.fileno()
         self._quit_pipe = quit_pipe
+        # Submitted datasets are only weakly referenced, so that a dataset
+        # the program drops can still be closed by its __del__.
         self._datasets = weakref.WeakValueDictionary()
         self._progress_dict = {}
 
-        self._runwaitlock = threading.Lock()
-        self._runwaitcv = threading.Condition(self._runwaitlock)
-        self._runwaitlist = None
+        # Set whenever a dataset finishes computing.  Only the single job
+        # thread waits on it, so no lock is needed around the ready check.
+        self._computed_event = threading.Event()
+        # Datasets held back while submissions are being batched.
+        self._pending_submissions = None
+
+        # Messages are dispatched on their exact type.
+        self._handlers = {
+                BucketReady: self._on_bucket_ready,
+                BucketReadyBatch: self._on_bucket_ready_batch,
+                ProgressUpdate: self._on_progress_update,
+                DatasetComputed: self._on_dataset_computed,
+                QuitJobProcess: self._on_quit_job_process,
+                }
 
     def run(self):
         """Repeatedly read from the pipe."""
-        poll = select.poll()
-        poll.register(self._pipe, select.POLLIN)
-        poll.register(self._quit_pipe, select.POLLIN)
-
+        if selectors is not None:
+            # The selector picks the best mechanism for the platform.
+            poll = selectors.DefaultSelector()
+            poll.register(self._pipe_fd, selectors.EVENT_READ)
+            poll.register(self._quit_pipe, selectors.EVENT_READ)
+            def ready_fds():
+                return [key.fd for key, event in poll.select()]
+        else:
+            if hasattr(select, 'epoll'):
+                # Edge-triggered polling is safe because each wakeup drains
+                # the pipe (and the quit pipe ends the loop).
+                poll = select.epoll()
+                poll.register(self._pipe_fd, select.EPOLLIN | select.EPOLLET)
+                poll.register(self._quit_pipe,
+                        select.EPOLLIN | select.EPOLLET)
+            else:
+                poll = select.poll()
+                poll.register(self._pipe_fd, select.POLLIN)
+                poll.register(self._quit_pipe, select.POLLIN)
+            def ready_fds():
+                return [fd for fd, event in poll.poll()]
+
+        pipe_fd = self._pipe_fd
+        recv = self._pipe.recv
+        pending = self._pipe.poll
+        handle_message = self.handle_message
         try:
             while True:
-                for fd, event in poll.poll():
-                        if fd == self._pipe.fileno():
-                            message = self._pipe.recv()
-                            self.handle_message(message)
-                        elif fd == self._quit_pipe:
-                            os.read(self._quit_pipe, 4096)
-                            return
-                        else:
-                            assert False
+                for fd in ready_fds():
+                    # Only the two registered fds can be returned.
+                    if fd == pipe_fd:
+                        # Handle every message that has already arrived
+                        # instead of going back to poll for each one.
+                        handle_message(recv())
+                        while pending():
+                            handle_message(recv())
+                    else:
+                        # The quit pipe only ever carries a single byte.
+                        os.read(self._quit_pipe, 1)
+                        return
         except (EOFError, KeyboardInterrupt):
             return
+        finally:
+            if hasattr(poll, 'close'):
+                poll.close()
 
     def handle_message(self, message):
-        if isinstance(message, BucketReady):
-            try:
-                ds = self._datasets[message.dataset_id]
-            except KeyError:
-                ds = None
+        handler = self._handlers.get(type(message))
+        assert handler is not None, 'Unknown message type.'
+        handler(message)
+
+    def _on_bucket_ready(self, message):
+        ds = self._datasets.get(message.dataset_id)
+
+        bucket = message.bucket
 
-            bucket = message.bucket
+        if ds is not None:
+            ds[bucket.source, bucket.split] = bucket
 
-            if ds is not None:
+    def _on_bucket_ready_batch(self, message):
+        ds = self._datasets.get(message.dataset_id)
+
+        if ds is not None:
+            for source, split, url in message.urls:
+                ds[source, split].url = url
+            for bucket in message.buckets:
                 ds[bucket.source, bucket.split] = bucket
-        elif isinstance(message, ProgressUpdate):
-            try:
-                ds = self._datasets[message.dataset_id]
-            except KeyError:
-                ds = None
-
-            self._progress_dict[message.dataset_id] = message.fraction_complete
-        elif isinstance(message, DatasetComputed):
-            try:
-                ds = self._datasets[message.dataset_id]
-            except KeyError:
-                ds = None
-
-            del self._progress_dict[message.dataset_id]
-
-            if ds is not None:
-                ds.notify_urls_known()
-                if message.fetched:
-                    ds._fetched = True
-                with self._runwaitcv:
-                    ds.computation_done()
-                    self._runwaitcv.notify()
-        elif isinstance(message, QuitJobProcess):
-            return
-        else:
-            assert False, 'Unknown message type.'
+
+    def _on_progress_update(self, message):
+        # Progress is tracked by dataset id alone, so there is no need to
+        # look up the dataset itself.
+        self._progress_dict[message.dataset_id] = message.fraction_complete
+
+    def _on_dataset_computed(self, message):
+        ds = self._datasets.get(message.dataset_id)
+
+        self._progress_dict.pop(message.dataset_id, None)
+
+        if ds is not None:
+            ds.notify_urls_known()
+            if message.fetched:
+                ds._fetched = True
+            ds.computation_done()
+            self._computed_event.set()
+
+    def _on_quit_job_process(self, message):
+        return
 
     def submit(self, dataset):
         """Sends the given dataset to the implementation."""
@@ -402,18 +479,36 @@ class DataManager(object):
             self._progress_dict[dataset.id] = 0.0
         # TODO: if we're running parallel PSO and the dataset is a LocalData,
         # then convert it to FileData to avoid serializing unnecessary data.
-        message = DatasetSubmission(dataset)
-        self._pipe.send(message)
+        if self._pending_submissions is not None:
+            self._pending_submissions.append(dataset)
+        else:
+            message = DatasetSubmission(dataset)
+            self._pipe.send(message)
+
+    def begin_batch(self):
+        """Hold submitted datasets until `flush_batch` is called."""
+        if self._pending_submissions is None:
+            self._pending_submissions = []
+
+    def flush_batch(self):
+        """Sends any held datasets to the implementation in one message."""
+        pending = self._pending_submissions
+        if pending is not None:
+            self._pending_submissions = None
+            if pending:
+                self._pipe.send(DatasetSubmissionBatch(pending))
 
     def done(self, exitcode=True):
         """Signals that the job is done (and the program should quit).
 
         The boolean value indicates whether execution was successful.
         """
+        self.flush_batch()
         self._pipe.send(JobDone(exitcode))
 
     def close_dataset(self, dataset):
         """Called when a dataset is closed.  Reports this to the impl."""
+        self.flush_batch()
         self._pipe.send(CloseDataset(dataset.id))
 
     def wait(self, *datasets, **kwds):
@@ -423,24 +518,30 @@ class DataManager(object):
         of seconds to wait before giving up.  The wait function returns a
         list of datasets that are ready.
         """
-        timeout = kwds.get('timeout', None)
+        self.flush_batch()
 
-        with self._runwaitcv:
-            self._runwaitlist = datasets
+        # Fast path: don't touch the event if a dataset is already done.
+        ready_list = self._check_ready(datasets)
+        if ready_list:
+            return ready_list
 
+        timeout = kwds.get('timeout', None)
+        if timeout is not None:
+            last_time = time.time()
+
+        while True:
+            # Clear before checking so that a completion that happens after
+            # the check still wakes the wait below.
+            self._computed_event.clear()
+            ready_list = self._check_ready(datasets)
+            if ready_list or (timeout is not None and timeout < 0):
+                break
+
+            self._computed_event.wait(timeout)
             if timeout is not None:
-                last_time = time.time()
-
-            while True:
-                ready_list = self._check_runwaitlist()
-                if ready_list or (timeout is not None and timeout < 0):
-                    break
-
-                self._runwaitcv.wait(timeout)
-                if timeout is not None:
-                    now = time.time()
-                    timeout -= now - last_time
-            self._runwaitlist = None
+                now = time.time()
+                timeout -= now - last_time
+                last_time = now
         return ready_list
 
     def progress(self, dataset):
@@ -450,37 +551,62 @@ class DataManager(object):
         except KeyError:
             return 1.0
 
-    def _check_runwaitlist(self):
-        """Finds whether any dataset in the runwaitlist is ready.
+    def _check_ready(self, datasets):
+        """Finds whether any of the given datasets are ready.
 
-        Returns a list of all datasets that are ready or None if the
-        runwaitlist is not set.  This should only be called when the
-        _runwaitcv lock is held.
+        Returns a list of all datasets that are ready or None if no datasets
+        were given.
         """
-        assert self._runwaitlock.locked()
-        runwaitlist = self._runwaitlist
-        if runwaitlist:
-            return [ds for ds in runwaitlist if not ds.computing]
+        if datasets:
+            return [ds for ds in datasets if not ds.computing]
         else:
             return None
 
 
-class JobToRunner(object):
+class Message(object):
+    """Base class for messages sent over the job pipe.
+
+    Messages have no per-instance dict, and they pickle as their class and
+    constructor arguments, so subclasses must list their slots in the same
+    order as the arguments to __init__.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (self.__class__,
+                tuple(getattr(self, name) for name in self.__slots__))
+
+
+class JobToRunner(Message):
     """Message from the job to the MapReduce implementation."""
+    __slots__ = ()
 
 
-class RunnerToJob(object):
+class RunnerToJob(Message):
     """Message from the MapReduce implementation to the job."""
+    __slots__ = ()
 
 
 class DatasetSubmission(JobToRunner):
     """Submission of a new non-computed dataset."""
+    __slots__ = ('dataset',)
+
     def __init__(self, ds):
         self.dataset = ds
 
 
+class DatasetSubmissionBatch(JobToRunner):
+    """Submission of several datasets at once, in order."""
+    __slots__ = ('datasets',)
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+
 class CloseDataset(JobToRunner):
     """Close the specified dataset, deleting all associated data."""
+    __slots__ = ('dataset_id',)
+
     def __init__(self, dataset_id):
         self.dataset_id = dataset_id
 
@@ -490,12 +616,16 @@ class JobDone(JobToRunner):
 
     The success attribute indicates whether execution succeeded.
     """
+    __slots__ = ('exitcode',)
+
     def __init__(self, exitcode):
         self.exitcode = exitcode
 
 
 class BucketReady(RunnerToJob):
     """The given Bucket is ready."""
+    __slots__ = ('dataset_id', 'bucket')
+
     def __init__(self, dataset_id, bucket):
         self.dataset_id = dataset_id
         # TODO: right now, the Serial impl sends the whole bucket with all
@@ -505,7 +635,25 @@ class BucketReady(RunnerToJob):
         self.bucket = bucket
 
 
+class BucketReadyBatch(RunnerToJob):
+    """The given Buckets (all from the same dataset) are ready.
+
+    This is equivalent to a BucketReady message for each bucket, but it is
+    sent and received as a single message.  Buckets that are only known by
+    url are sent as plain (source, split, url) tuples in `urls`, so that only
+    buckets that actually hold data need to be pickled as Bucket objects.
+    """
+    __slots__ = ('dataset_id', 'urls', 'buckets')
+
+    def __init__(self, dataset_id, urls, buckets=()):
+        self.dataset_id = dataset_id
+        self.urls = urls
+        self.buckets = buckets
+
+
 class ProgressUpdate(RunnerToJob):
+    __slots__ = ('dataset_id', 'fraction_complete')
+
     def __init__(self, dataset_id, fraction_complete):
         self.dataset_id = dataset_id
         self.fraction_complete = fraction_complete
@@ -517,6 +665,8 @@ class DatasetComputed(RunnerToJob):
     The fetched attribute indicates whether the previously sent buckets (in
     BucketReady messages) contained data or just urls.
     """
+    __slots__ = ('dataset_id', 'fetched')
+
     def __init__(self, dataset_id, fetched):
         self.dataset_id = dataset_id
         self.fetched = fetched
@@ -524,5 +674,6 @@ class DatasetComputed(RunnerToJob):
 
 class QuitJobProcess(RunnerToJob):
     """The implementation has received the JobDone message and is quitting."""
+    __slots__ = ()
 
 # vim: et sw=4 sts=4
@@ -269,6 +269,7 @@ class Implementation(BaseImplementation):
             logger.critical('Quitting due to keyboard interrupt.')
             exitcode = 1
         finally:
+            # The job process reads exactly one byte from the quit pipe.
             os.write(job_quit_pipe, b'\0')
             self.stop_worker_process()
 
@@ -22,6 +22,7 @@ to create much more complex programs.
 
 from __future__ import division, print_function
 
+import binascii
 import hashlib
 import sys
 
@@ -126,9 +127,10 @@ class MapReduce(object):
             return 1
 
         try:
-            intermediate = self.make_map_data(job, source)
+            with job.batched():
+                intermediate = self.make_map_data(job, source)
+                output = self.make_reduce_data(job, intermediate)
             source.close()
-            output = self.make_reduce_data(job, intermediate)
             intermediate.close()
             output.close()
 
@@ -179,8 +181,7 @@ class MapReduce(object):
             equally as possible.
             """
             digest = hashlib.md5(serialized_key).digest()
-            big_endian_digest = ''.join(reversed(digest))
-            return int(big_endian_digest.encode('hex'), 16) % n
+            return int(binascii.hexlify(digest[::-1]), 16) % n
 
     def hash_partition(self, key, serialized_key, n):
         """A partition function that hashes the key (DEPRECATED).
@@ -200,6 +201,9 @@ class MapReduce(object):
         deprecated.
         """
         return hash(key) % n
+    # Lets the partitioning loop compute `hash(key) % n` without calling
+    # this method for each key (see LocalData).
+    hash_partition.partition_key = hash
 
     def mod_partition(self, key, serialized_key, n):
         """A partition function that partitions by modding the key.
@@ -208,6 +212,7 @@ class MapReduce(object):
         want to make sure that the partitions are sized equally.
         """
         return int(key) % n
+    mod_partition.partition_key = int
 
     # The default partition function is md5_partition:
     partition = md5_partition
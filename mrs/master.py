@@ -130,7 +130,11 @@ class MasterRunner(runner.TaskRunner):
         The actual data is ignored--the pipe is just a mechanism for alerting
         the runner that the schedule method needs to be called.
         """
+        # Drain the pipe before re-arming the trigger.  A trigger that comes
+        # in after sched_triggered writes a fresh byte that the read can no
+        # longer consume, and any state change before it is seen by schedule.
         os.read(self.sched_pipe, 4096)
+        self.slaves.sched_triggered()
         self.schedule()
 
     def schedule(self):
@@ -707,6 +711,7 @@ class Slaves(object):
     """List of remote slaves."""
     def __init__(self, sched_pipe, chore_queue, rpc_timeout, pingdelay):
         self._sched_pipe = sched_pipe
+        self._sched_pending = False
         self.chore_queue = chore_queue
         self.rpc_timeout = rpc_timeout
         self.pingdelay = pingdelay
@@ -722,8 +727,18 @@ class Slaves(object):
         self._failed_tasks = collections.deque()
 
     def trigger_sched(self):
-        """Wakes up the runner for scheduling by sending it a byte."""
-        os.write(self._sched_pipe, b'\0')
+        """Wakes up the runner for scheduling by sending it a byte.
+
+        Triggers are coalesced: no byte is written if the runner has not yet
+        responded to the previous one.
+        """
+        if not self._sched_pending:
+            self._sched_pending = True
+            os.write(self._sched_pipe, b'\0')
+
+    def sched_triggered(self):
+        """Called by the runner when it wakes up to schedule."""
+        self._sched_pending = False
 
     def get_slave(self, slave_id, cookie):
         """Find the slave associated with the given slave_id."""
@@ -900,18 +915,9 @@ class IdleSlaves(object):
 
     def discard(self, slave):
         """Remove the given slave from the set, if present."""
-        self._all_slaves.discard(slave)
-        host = slave.host
-
-        # Find the host's slave set and remove it from the counter.
-        slave_set = self._host_map[host]
-        self._remove_from_counter(host, len(slave_set))
-
-        # Discard the host from the slave_set.
-        slave_set.discard(slave)
-
-        # Reinsert the slave_set with its new count.
-        self._add_to_counter(host, len(slave_set))
+        # Busy or dead slaves are usually absent, so skip the bookkeeping.
+        if slave in self._all_slaves:
+            self.remove(slave)
 
     def pop(self):
         """Remove and return a slave from the most idle host."""
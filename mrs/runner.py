@@ -17,7 +17,9 @@
 
 from __future__ import division, print_function
 
+import bisect
 import collections
+import itertools
 import os
 import sys
 import time
@@ -65,8 +67,8 @@ class BaseRunner(object):
         close_requests: set of Datasets requested to be closed by the job
             process (but which cannot be closed until their dependents are
             computed)
-        data_dependents: maps a dataset id to a deque listing datasets that
-            cannot start until it has finished
+        data_dependents: maps a dataset id to a set of datasets that cannot
+            start until it has finished
         datasets: maps a dataset id to the corresponding Dataset object
     """
 
@@ -87,26 +89,29 @@ class BaseRunner(object):
                     self.read_worker_pipe)
 
         self.datasets = {}
-        self.data_dependents = collections.defaultdict(collections.deque)
+        self.data_dependents = collections.defaultdict(set)
 
     def read_job_conn(self):
-        try:
-            message = self.job_conn.recv()
-        except EOFError:
-            return
+        """Handle every message that is ready on the job connection."""
+        job_conn = self.job_conn
+        while self.event_loop.running and job_conn.poll(0):
+            try:
+                message = job_conn.recv()
+            except EOFError:
+                return
+            self._dispatch_job_message(message)
 
+    def _dispatch_job_message(self, message):
         if isinstance(message, job.DatasetSubmission):
-            ds = message.dataset
-            # Fix the breaking of serializers caused by pickling.
-            if ds.serializers is not None:
-                ds.serializers = serializers.from_names(ds.serializers,
-                        self.program_class)
-            self.datasets[ds.id] = ds
-            input_id = getattr(ds, 'input_id', None)
-            if input_id:
-                self.data_dependents[input_id].append(ds.id)
-            if isinstance(ds, computed_data.ComputedData):
-                self.compute_dataset(ds)
+            self.add_dataset(message.dataset)
+        elif isinstance(message, job.DatasetSubmissionBatch):
+            # Register the whole batch before computing any of it, so that
+            # each dataset is scheduled knowing what depends on it.
+            for ds in message.datasets:
+                self.register_dataset(ds)
+            for ds in message.datasets:
+                if isinstance(ds, computed_data.ComputedData):
+                    self.compute_dataset(ds)
         elif isinstance(message, job.CloseDataset):
             ds = self.datasets[message.dataset_id]
             self.close_dataset(ds)
@@ -119,6 +124,23 @@ class BaseRunner(object):
         else:
             assert False, 'Unknown message type.'
 
+    def add_dataset(self, ds):
+        """Called when a new dataset is submitted by the job."""
+        self.register_dataset(ds)
+        if isinstance(ds, computed_data.ComputedData):
+            self.compute_dataset(ds)
+
+    def register_dataset(self, ds):
+        """Records a submitted dataset without starting its computation."""
+        # Fix the breaking of serializers caused by pickling.
+        if ds.serializers is not None:
+            ds.serializers = serializers.from_names(ds.serializers,
+                    self.program_class)
+        self.datasets[ds.id] = ds
+        input_id = ds.input_id
+        if input_id:
+            self.data_dependents[input_id].add(ds.id)
+
     def run(self):
         raise NotImplementedError
 
@@ -140,17 +162,23 @@ class BaseRunner(object):
         self.send_dataset_response(dataset)
 
         # TODO: preface with `if not self.opts.checkpointing:` or similar.
-        input_id = getattr(dataset, 'input_id', None)
+        input_id = dataset.input_id
         # Completing computation decrements the refcount of the input dataset.
         self.data_dependents[input_id].remove(dataset.id)
         self.try_to_remove_recursive(input_id)
 
     def send_dataset_response(self, dataset):
         if not dataset.closed:
+            urls = []
+            buckets = []
             for bucket in dataset[:, :]:
-                if len(bucket) or bucket.url:
-                    response = job.BucketReady(dataset.id, bucket)
-                    self.job_conn.send(response)
+                if len(bucket):
+                    buckets.append(bucket)
+                elif bucket.url:
+                    urls.append((bucket.source, bucket.split, bucket.url))
+            if urls or buckets:
+                response = job.BucketReadyBatch(dataset.id, urls, buckets)
+                self.job_conn.send(response)
         response = job.DatasetComputed(dataset.id, not dataset.closed)
         self.job_conn.send(response)
 
@@ -191,16 +219,15 @@ class BaseRunner(object):
         if not ds or not self.can_remove_dataset(ds):
             return
 
-        input_id = getattr(ds, 'input_id', None)
+        input_id = ds.input_id
         self.remove_dataset(ds)
         # Decrement the refcount on the input dataset.
         if input_id:
-            input_dependents = self.data_dependents[input_id]
-            if dataset_id in input_dependents:
-                input_dependents.remove(dataset_id)
-                return [input_id]
-            else:
+            dependents = self.data_dependents.get(input_id)
+            if not dependents or dataset_id not in dependents:
                 return
+            dependents.remove(dataset_id)
+            return [input_id]
         else:
             return
 
@@ -212,12 +239,12 @@ class BaseRunner(object):
             return False
 
         # If the dataset has dependents, then its refcount is non-zero.
-        deplist = self.data_dependents[dataset.id]
-        if deplist:
+        # Use get so that checking doesn't create an empty entry.
+        if self.data_dependents.get(dataset.id):
             return False
 
         # Skip permanent datasets that are not yet computed.
-        if dataset.permanent and getattr(dataset, 'computing', False):
+        if dataset.permanent and dataset.computing:
             return False
 
         return True
@@ -235,7 +262,7 @@ class BaseRunner(object):
         else:
             dataset.delete()
         del self.datasets[dataset.id]
-        del self.data_dependents[dataset.id]
+        self.data_dependents.pop(dataset.id, None)
 
     def debug_status(self):
         """Print out the debug info about the current status of the runner."""
@@ -250,7 +277,9 @@ class TaskRunner(BaseRunner):
 
     Attributes:
         pending_datasets: set of datasets that are not yet runnable
-        runnable_datasets: deque of datasets that are running or ready to run
+        runnable_datasets: list of datasets that are running or ready to run,
+            ordered so that datasets with the most (transitively) dependent
+            tasks come first, then by submission order
         tasklists: map from a dataset id to the corresponding TaskList
         forward_links: map from a dataset id to a set of ids representing
             the transitive closure of datasets that backlink to it
@@ -261,7 +290,11 @@ class TaskRunner(BaseRunner):
         super(TaskRunner, self).__init__(*args)
 
         self.pending_datasets = set()
-        self.runnable_datasets = collections.deque()
+        self.runnable_datasets = []
+        # Sort keys parallel to runnable_datasets.
+        self._runnable_keys = []
+        self._submit_seq = {}
+        self._submit_counter = itertools.count()
         self.tasklists = {}
         self.forward_links = collections.defaultdict(set)
         self.transitive_backlinks = collections.defaultdict(set)
@@ -292,6 +325,7 @@ class TaskRunner(BaseRunner):
         os.read(self.chore_queue_pipe, 4096)
 
     def compute_dataset(self, dataset):
+        self._submit_seq[dataset.id] = next(self._submit_counter)
         backlink_id = dataset.backlink_id
         while backlink_id and backlink_id in self.datasets:
             self.forward_links[backlink_id].add(dataset.id)
@@ -347,13 +381,18 @@ class TaskRunner(BaseRunner):
                 break
         return None
 
-    def available_tasks(self):
-        """Returns the number of available tasks."""
+    def available_tasks(self, limit=None):
+        """Returns the number of available tasks.
+
+        If a limit is given, counting stops as soon as it is reached.
+        """
         count = 0
         for ds in self.runnable_datasets:
             tasklist = self.tasklists.get(ds.id)
             if tasklist is not None:
                 count += len(tasklist)
+                if limit is not None and count >= limit:
+                    break
         return count
 
     def make_tasklist(self, ds):
@@ -422,11 +461,11 @@ class TaskRunner(BaseRunner):
 
         dataset = self.datasets[dataset_id]
         for split, url in outurls:
-            bucket = dataset[task_index, split]
-            bucket.url = url
-            if not dataset.closed:
-                response = job.BucketReady(dataset_id, bucket)
-                self.job_conn.send(response)
+            dataset[task_index, split].url = url
+        if outurls and not dataset.closed:
+            urls = [(task_index, split, url) for split, url in outurls]
+            response = job.BucketReadyBatch(dataset_id, urls)
+            self.job_conn.send(response)
         if tasklist.time_to_report_progress():
             response = job.ProgressUpdate(dataset_id,
                     tasklist.fraction_complete())
@@ -461,9 +500,43 @@ class TaskRunner(BaseRunner):
                 raise RuntimeError(msg)
 
     def dataset_done(self, dataset):
-        self.runnable_datasets.remove(dataset)
+        i = self.runnable_datasets.index(dataset)
+        del self.runnable_datasets[i]
+        del self._runnable_keys[i]
         super(TaskRunner, self).dataset_done(dataset)
 
+    def _make_runnable(self, ds):
+        """Add the dataset to runnable_datasets in priority order.
+
+        Datasets that more tasks are waiting on are scheduled first, so that
+        downstream work becomes available as early as possible.  With the
+        sequential_datasets option, submission order alone is used.
+        """
+        if self.opts.mrs__sequential_datasets:
+            priority = 0
+        else:
+            priority = self._dependent_tasks(ds.id)
+        key = (-priority, self._submit_seq[ds.id])
+        i = bisect.bisect(self._runnable_keys, key)
+        self._runnable_keys.insert(i, key)
+        self.runnable_datasets.insert(i, ds)
+
+    def _dependent_tasks(self, dataset_id):
+        """Counts the tasks of all datasets that depend on the given one."""
+        count = 0
+        seen = set()
+        stack = list(self.data_dependents.get(dataset_id, ()))
+        while stack:
+            dep_id = stack.pop()
+            if dep_id in seen:
+                continue
+            seen.add(dep_id)
+            dep_ds = self.datasets.get(dep_id)
+            if dep_ds is not None:
+                count += getattr(dep_ds, 'ntasks', 0)
+            stack.extend(self.data_dependents.get(dep_id, ()))
+        return count
+
     def _wakeup_dependents(self, dataset_id):
         """Move any dependent datasets possible from pending to runnable."""
 
@@ -472,26 +545,31 @@ class TaskRunner(BaseRunner):
         except KeyError:
             return
         if ds.computing:
-            fraction_complete = self.tasklists[dataset_id].fraction_complete()
+            tasklist = self.tasklists[dataset_id]
+            done = tasklist.complete()
         else:
-            fraction_complete = 1
+            done = True
 
-        if fraction_complete < 1:
+        if not done:
+            fraction_complete = tasklist.fraction_complete()
             if fraction_complete < ds.blocking_ratio:
                 return
-            if self.available_tasks() >= self.available_workers():
+            # This is checked after every completed task, so only count as
+            # many available tasks as needed to compare with the workers.
+            workers = self.available_workers()
+            if self.available_tasks(workers) >= workers:
                 return
 
         wakeup_count = 0
-        for dependent_id in self.data_dependents[dataset_id]:
+        for dependent_id in self.data_dependents.get(dataset_id, ()):
             dep_ds = self.datasets[dependent_id]
             if (dep_ds in self.pending_datasets and
-                    (fraction_complete == 1 or dep_ds.async_start)):
+                    (done or dep_ds.async_start)):
                 wakeup_count += 1
                 self.pending_datasets.remove(dep_ds)
-                self.runnable_datasets.append(dep_ds)
+                self._make_runnable(dep_ds)
 
-        if wakeup_count and fraction_complete < 1:
+        if wakeup_count and not done:
             logger.info('Wakeup children of %s at %.2f complete' %
                     (dataset_id, fraction_complete))
 
@@ -505,11 +583,11 @@ class TaskRunner(BaseRunner):
         Returns whether the dataset is runnable.
         """
         input_ds = self.datasets.get(ds.input_id, None)
-        if (input_ds is None) or getattr(input_ds, 'computing', False):
+        if (input_ds is None) or input_ds.computing:
             self.pending_datasets.add(ds)
             return False
         else:
-            self.runnable_datasets.append(ds)
+            self._make_runnable(ds)
             return True
 
     def schedule(self):
@@ -525,8 +603,9 @@ class TaskRunner(BaseRunner):
             del self.tasklists[dataset.id]
         except KeyError:
             pass
+        self._submit_seq.pop(dataset.id, None)
         del self.datasets[dataset.id]
-        del self.data_dependents[dataset.id]
+        self.data_dependents.pop(dataset.id, None)
         if dataset.permanent:
             dataset.clear()
         else:
@@ -564,6 +643,9 @@ class TaskRunner(BaseRunner):
 
 class TaskList(object):
     """Manages the list of tasks associated with a single dataset."""
+    __slots__ = ('dataset', 'input_ds', '_remaining_tasks', '_ready_tasks',
+            '_tasks_made', '_async_incomplete', '_num_tasks',
+            '_last_progress_report', '_failures')
 
     def __init__(self, dataset, input_ds):
         self.dataset = dataset
@@ -586,19 +668,26 @@ class TaskList(object):
         Backlinked tasks get added to the remaining_tasks set but not to the
         ready_tasks set.  Done tasks aren't added to either.
         """
+        input_ds = self.input_ds
+        ready_tasks = self._ready_tasks
+        remaining_tasks = self._remaining_tasks
         for task_index in range(self.dataset.ntasks):
             if task_index in done_tasks:
                 pass
             elif task_index in backlink_tasks:
-                self._remaining_tasks.add(task_index)
+                remaining_tasks.add(task_index)
             else:
-                for b in self.input_ds[:, task_index]:
-                    # Don't add empty or incomplete sources.
-                    if b.url and (b.source not in incomplete_sources):
-                        self._ready_tasks.append(task_index)
-                        self._remaining_tasks.add(task_index)
-                        break
-        self._num_tasks = len(self._remaining_tasks)
+                buckets = input_ds[:, task_index]
+                # Don't add empty or incomplete sources.
+                if incomplete_sources:
+                    ready = any(b.url and (b.source not in incomplete_sources)
+                            for b in buckets)
+                else:
+                    ready = any(b.url for b in buckets)
+                if ready:
+                    ready_tasks.append(task_index)
+                    remaining_tasks.add(task_index)
+        self._num_tasks = len(remaining_tasks)
         self._tasks_made = True
 
     def async_incomplete(self):
@@ -652,9 +741,11 @@ class TaskList(object):
         """Push back a failed task.
 
         Called if, for example, a Task is aborted.  Returns the number of
-        times that this particular task has failed.
+        times that this particular task has failed.  The task goes to the
+        front of the deque so that the retry doesn't wait behind every other
+        ready task (which would leave the whole dataset waiting on it).
         """
-        self._ready_tasks.append(task_index)
+        self._ready_tasks.appendleft(task_index)
         self._failures[task_index] += 1
         return self._failures[task_index]
 
@@ -16,10 +16,14 @@
 """Mrs Serial Runner"""
 
 import multiprocessing
-import select
 import threading
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from . import runner
 
 import logging
@@ -32,6 +36,7 @@ class SerialRunner(runner.BaseRunner):
 
         self.program = None
         self.worker_conn = None
+        self.worker_requests = None
 
     def run(self):
         try:
@@ -49,8 +54,12 @@ class SerialRunner(runner.BaseRunner):
         return self.exitcode
 
     def start_worker(self):
-        self.worker_conn, remote_worker_conn = multiprocessing.Pipe()
-        worker = SerialWorker(self.program, self.datasets, remote_worker_conn)
+        # The worker is a thread, so dataset ids can be handed over directly.
+        # Responses still go through a pipe to wake up the event loop.
+        self.worker_requests = queue.Queue()
+        self.worker_conn, remote_worker_conn = multiprocessing.Pipe(False)
+        worker = SerialWorker(self.program, self.datasets,
+                self.worker_requests, remote_worker_conn)
         worker_thread = threading.Thread(target=worker.run,
                 name='Serial Worker')
         worker_thread.daemon = True
@@ -58,45 +67,45 @@ class SerialRunner(runner.BaseRunner):
 
     def compute_dataset(self, dataset):
         """Called when a new ComputedData set is submitted."""
-        self.worker_conn.send(dataset.id)
+        self.worker_requests.put(dataset.id)
 
     def read_worker_conn(self):
-        """Read a response from the worker.
+        """Read all ready responses from the worker.
 
         Each SerialWorkerSuccess response will contain an id of a dataset
         that has finished being computed.
         """
-        try:
-            response = self.worker_conn.recv()
-            if isinstance(response, SerialWorkerSuccess):
-                dataset_id = response.dataset_id
-            else:
-                logger.error(response.traceback)
+        worker_conn = self.worker_conn
+        while self.event_loop.running and worker_conn.poll(0):
+            try:
+                response = worker_conn.recv()
+                if isinstance(response, SerialWorkerSuccess):
+                    dataset_id = response.dataset_id
+                else:
+                    logger.error(response.traceback)
+                    self.exitcode = 1
+                    self.event_loop.running = False
+                    return
+            except EOFError:
+                logger.critical('Got an EOF from the Worker')
                 self.exitcode = 1
                 self.event_loop.running = False
                 return
-        except EOFError:
-            logger.critical('Got an EOF from the Worker')
-            self.exitcode = 1
-            self.event_loop.running = False
-            return
-        ds = self.datasets[dataset_id]
-        self.dataset_done(ds)
+            ds = self.datasets[dataset_id]
+            self.dataset_done(ds)
 
 
 class SerialWorker(object):
-    def __init__(self, program, datasets, conn):
+    def __init__(self, program, datasets, requests, conn):
         self.program = program
         self.datasets = datasets
+        self.requests = requests
         self.conn = conn
 
     def run(self):
         while True:
+            dataset_id = self.requests.get()
             try:
-                try:
-                    dataset_id = self.conn.recv()
-                except EOFError:
-                    return
                 ds = self.datasets[dataset_id]
                 ds.run_serial(self.program, self.datasets)
                 response = SerialWorkerSuccess(dataset_id)
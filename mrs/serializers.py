@@ -18,12 +18,15 @@ from __future__ import division, print_function
 from collections import namedtuple
 import functools
 import struct
+import sys
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+PY3 = sys.version_info[0] == 3
+
 
 Serializer = namedtuple('Serializer', ('dumps', 'loads'))
 
@@ -54,6 +57,7 @@ def output_serializers(**kwargs):
 
 class Serializers(object):
     """Keeps track of a pair of serializers and their names."""
+    __slots__ = ('key_s', 'key_s_name', 'value_s', 'value_s_name')
 
     def __init__(self, key_s, key_s_name, value_s,
             value_s_name):
@@ -62,6 +66,12 @@ class Serializers(object):
         self.value_s = value_s
         self.value_s_name = value_s_name
 
+    def __reduce__(self):
+        # Buckets pickle their serializers, and slots need explicit support
+        # with older pickle protocols.
+        return (Serializers, (self.key_s, self.key_s_name, self.value_s,
+            self.value_s_name))
+
     def __repr__(self):
         return 'Serializers(%r, %r, %r, %r)' % (self.key_s,
                 self.key_s_name, self.value_s, self.value_s_name)
@@ -170,11 +180,26 @@ str_serializer = Serializer(str_dumps, str_loads)
 ###############################################################################
 # int <-> bytes
 
+# Small integers are common keys, so their encodings are computed once.
+_SMALL_INT_MIN = -128
+_SMALL_INT_MAX = 256
+_small_int_bytes = tuple(str(i).encode('ascii')
+        for i in range(_SMALL_INT_MIN, _SMALL_INT_MAX))
+if PY3:
+    _int_types = (int,)
+else:
+    _int_types = (int, long)
+
 def int_dumps(i):
+    # Anything other than an exact int (such as a float or a bool) takes the
+    # general path, as does any int outside the table.
+    if type(i) in _int_types and _SMALL_INT_MIN <= i < _SMALL_INT_MAX:
+        return _small_int_bytes[i - _SMALL_INT_MIN]
     return str(i).encode('utf-8')
 
 def int_loads(b):
-    return int(b.decode('utf-8'))
+    # int() parses ASCII digits in bytes directly.
+    return int(b)
 
 int_serializer = Serializer(int_dumps, int_loads)
 
@@ -227,4 +252,26 @@ def make_protobuf_serializer(protobuf):
 
     return Serializer(protobuf_dumps, protobuf_loads)
 
+###############################################################################
+# MessagePack <-> bytes
+
+def make_msgpack_serializer():
+    """Create a serializer that uses MessagePack.
+
+    MessagePack encodes ints, floats, strings, bytes, lists, and dicts in C,
+    which is generally much faster and more compact than pickle.  Note that
+    tuples are loaded as lists.  Requires the `msgpack` package.
+
+    See: https://msgpack.org/
+    """
+    import msgpack
+
+    def msgpack_dumps(value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def msgpack_loads(b):
+        return msgpack.unpackb(b, raw=False)
+
+    return Serializer(msgpack_dumps, msgpack_loads)
+
 # vim: et sw=4 sts=4
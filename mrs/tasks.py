@@ -122,11 +122,12 @@ class Task(object):
             # is not a high priority.
             data = (copy.deepcopy(x) for x in uncopied_data)
             if sort:
-                data = sorted(data, key=itemgetter(0))
+                # Free the sorted copies as they are consumed.
+                data = util.drain(sorted(data, key=itemgetter(0)))
         elif sort:
-            tmpdir = util.mktempdir(default_dir, 'merge_%s_' % self.dataset_id)
             sorted_ds = datasets.MergeSortData(self.input_ds, self.task_index,
-                    max_sort_size, dir=tmpdir, _called_in_runner=True)
+                    max_sort_size, tmpdir_parent=default_dir,
+                    _called_in_runner=True)
             data = sorted_ds.stream_data(_called_in_runner=True)
             self.sorted_ds = sorted_ds
         else:
@@ -160,12 +161,13 @@ class Task(object):
             if self.storage:
                 self.outdir = self.storage
                 permanent = True
+                if self.splits > 1:
+                    prefix = 'source_%s_' % self.task_index
+                    self.outdir = util.mktempdir(self.outdir, prefix)
             else:
+                # A new temporary directory belongs to this task alone, so
+                # it doesn't need a per-source subdirectory.
                 self.outdir = util.mktempdir(default_dir, self.dataset_id + '_')
-
-            if self.splits > 1:
-                prefix = 'source_%s_' % self.task_index
-                self.outdir = util.mktempdir(self.outdir, prefix)
         return permanent
 
     def format(self):
@@ -265,9 +267,9 @@ class MapOperation(Operation):
             return map_iter
 
     def _map(self, mapper, input):
-        for inkey, invalue in input:
-            for key, value in mapper(inkey, invalue):
-                yield (key, value)
+        # Flatten the mapper's outputs without a Python-level loop.
+        mapped = itertools.starmap(mapper, input)
+        return itertools.chain.from_iterable(mapped)
 
     def to_args(self):
         return (self.op_name, self.map_name, self.combine_name,
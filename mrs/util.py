@@ -18,6 +18,7 @@
 from __future__ import division, print_function
 
 import errno
+from itertools import islice
 import math
 import os
 import random
@@ -26,8 +27,14 @@ import string
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from logging import getLogger
 logger = getLogger('mrs')
 
@@ -37,6 +44,10 @@ ID_CHARACTERS = string.ascii_letters + string.digits
 BITS_IN_DOUBLE = 53
 ID_MAXLEN = int(BITS_IN_DOUBLE * math.log(2) / math.log(len(ID_CHARACTERS)))
 ID_RANGES = [len(ID_CHARACTERS) ** i for i in range(ID_MAXLEN + 1)]
+# Items are passed from a prefetch thread in chunks of this size.
+PREFETCH_CHUNK_SIZE = 1000
+# Maximum number of chunks that a prefetch thread may get ahead.
+PREFETCH_CHUNKS = 16
 
 # Python 3 compatibility
 PY3 = sys.version_info[0] == 3
@@ -45,7 +56,7 @@ if not PY3:
 
 
 class EventLoop(object):
-    """A very simple event loop that wraps select.poll.
+    """A very simple event loop that wraps select.epoll (or select.poll).
 
     As far as event loops go, this is pretty lame.  Since the multiprocessing
     module's send/recv methods don't support partial reads, there will still
@@ -54,23 +65,40 @@ class EventLoop(object):
     write a simple replacement for multiprocessing's Pipe that supports
     partial reading and writing.
 
+    Where epoll is available, the kernel keeps the set of registered file
+    descriptors, so each wakeup only costs as much as the ready descriptors.
+    Polling is level-triggered because handlers read a single message per
+    call.
+
     Attributes:
-        handler_map: map from file descriptors to methods for handling reads
-        poll: poll object (from the select module)
+        handler_map: list, indexed by file descriptor, of methods for handling
+            reads (file descriptors are small ints, so indexing a list is
+            cheaper than a dict lookup)
+        poll: epoll or poll object (from the select module)
         running: bool indicating whether the event loop should continue
     """
     def __init__(self):
-        self.handler_map = {}
+        self.handler_map = []
         self.running = True
-        self.poll = select.poll()
+        if hasattr(select, 'epoll'):
+            self.poll = select.epoll()
+            self._pollin = select.EPOLLIN
+            self._epoll = True
+        else:
+            self.poll = select.poll()
+            self._pollin = select.POLLIN
+            self._epoll = False
 
     def register_fd(self, fd, handler):
         """Registers the given file descriptor and handler with poll.
 
         Assumes that the file descriptors are only used in read mode.
         """
-        self.handler_map[fd] = handler
-        self.poll.register(fd, select.POLLIN)
+        handler_map = self.handler_map
+        if fd >= len(handler_map):
+            handler_map.extend([None] * (fd + 1 - len(handler_map)))
+        handler_map[fd] = handler
+        self.poll.register(fd, self._pollin)
 
     def run(self, timeout_function=None):
         """Repeatedly calls poll to read from various file descriptors.
@@ -79,24 +107,91 @@ class EventLoop(object):
         value is used as the timeout for poll (None means to wait
         indefinitely).
         """
+        handler_map = self.handler_map
         while self.running:
             # Note that poll() is unaffected by siginterrupt/SA_RESTART (man
             # signal(7) for more detail), so we check explicitly for EINTR.
             try:
                 if timeout_function:
                     timeout = timeout_function()
-                    # Note that the timeout of poll is in milliseconds.
-                    if timeout is not None:
-                        timeout *= 1000
                 else:
                     timeout = None
+                if self._epoll:
+                    # The timeout of epoll is in seconds (-1 for no timeout).
+                    if timeout is None:
+                        timeout = -1
+                elif timeout is not None:
+                    # The timeout of poll is in milliseconds.
+                    timeout *= 1000
                 for fd, event in self.poll.poll(timeout):
-                    self.handler_map[fd]()
-            except select.error as e:
+                    handler_map[fd]()
+            except (select.error, IOError) as e:
+                # On Python 2, epoll raises IOError rather than select.error.
                 if e.args[0] != errno.EINTR:
                     raise
 
 
+def prefetch(iterable, chunk_size=PREFETCH_CHUNK_SIZE,
+        max_chunks=PREFETCH_CHUNKS):
+    """Iterate over the given iterable while reading ahead in a thread.
+
+    This lets blocking reads (e.g., downloads) overlap with whatever the
+    caller does with each item.  Items are passed through a bounded queue in
+    chunks to keep the per-item overhead low.  Any exception raised by the
+    iterable is reraised to the caller.  If the caller stops iterating early,
+    the thread gives up the next time that it would block.
+    """
+    chunks = queue.Queue(max_chunks)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_ahead():
+        try:
+            iterator = iter(iterable)
+            while not stopped.is_set():
+                chunk = list(islice(iterator, chunk_size))
+                put((chunk, None))
+                if not chunk:
+                    return
+        except Exception as e:
+            put((None, e))
+
+    thread = threading.Thread(target=read_ahead, name='Prefetch')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            chunk, error = chunks.get()
+            if error is not None:
+                raise error
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+    finally:
+        stopped.set()
+
+
+def drain(lst):
+    """Iterate over the given list, removing each item as it is yielded.
+
+    Once the caller is done with an item, it can be freed, so the list's
+    memory is released progressively instead of all at the end.
+    """
+    lst.reverse()
+    pop = lst.pop
+    while lst:
+        yield pop()
+
+
 def try_makedirs(path):
     """Do the equivalent of mkdir -p."""
     # Workaround for Python issue #14702:
@@ -147,22 +242,25 @@ def random_string(length):
         r /= choices
     return s
 
-def mktempfile(dir, prefix, suffix):
+def mktempfile(dir, prefix, suffix, bufsize=-1):
     """Creates and opens a new temporary file with a unique filename.
 
     Returns a (file object, path) pair.  The file is opened in binary write
-    mode.  This falls back to tempfile.NamedTemporaryFile if necessary, but by
-    default it uses the faster strategy of not adding random characters to the
-    filename.  Note that to save time, we don't set O_CLOEXEC, which is not
-    necessary in Mrs.
+    mode, with the given buffer size (-1 gives the system default).  This
+    falls back to tempfile.NamedTemporaryFile if necessary, but by default it
+    uses the faster strategy of not adding random characters to the filename.
+    Note that to save time, we don't set O_CLOEXEC, which is not necessary in
+    Mrs.
     """
     path = dir + '/' + prefix + suffix
     try:
         fd = os.open(path, TEMPFILE_FLAGS, 0o600)
-        f = os.fdopen(fd, 'wb')
+        f = os.fdopen(fd, 'wb', bufsize)
     except OSError:
-        f = tempfile.NamedTemporaryFile(delete=False, dir=dir,
-                prefix=prefix, suffix=suffix)
+        # The buffer size is passed positionally because the keyword is
+        # `bufsize` in Python 2 but `buffering` in Python 3.
+        f = tempfile.NamedTemporaryFile('w+b', bufsize, delete=False,
+                dir=dir, prefix=prefix, suffix=suffix)
         path = f.name
     return f, path
 
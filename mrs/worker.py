@@ -53,12 +53,20 @@ class WorkerRemoveRequest(object):
 
 
 class WorkerTaskRequest(object):
-    """Request the to worker to run a task."""
+    """Request the to worker to run a task.
+
+    Task requests and responses cross the worker pipe once per task, so they
+    have no per-instance dict and pickle as just their constructor arguments.
+    """
+    __slots__ = ('dataset_id', 'task_index', 'args')
 
     def __init__(self, *args):
         _, _, self.dataset_id, self.task_index, _, _, _, _, _ = args
         self.args = args
 
+    def __reduce__(self):
+        return (self.__class__, self.args)
+
     def id(self):
         return '%s_%s_%s' % (self.__class__.__name__, self.dataset_id,
                 self.task_index)
@@ -85,6 +93,9 @@ class WorkerSetupSuccess(object):
 
 class WorkerSuccess(object):
     """Successful response from worker."""
+    __slots__ = ('dataset_id', 'task_index', 'outdir', 'outurls',
+            'request_id')
+
     def __init__(self, dataset_id, task_index, outdir, outurls, request_id):
         self.dataset_id = dataset_id
         self.task_index = task_index
@@ -92,6 +103,10 @@ class WorkerSuccess(object):
         self.outurls = outurls
         self.request_id = request_id
 
+    def __reduce__(self):
+        return (self.__class__, (self.dataset_id, self.task_index,
+            self.outdir, self.outurls, self.request_id))
+
 
 class Worker(object):
     """Execute map tasks and reduce tasks.
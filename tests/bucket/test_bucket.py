@@ -1,5 +1,6 @@
 from mrs.bucket import WriteBucket
 from mrs import BinWriter, HexWriter
+from mrs.serializers import dumps_functions
 
 def test_writebucket():
     b = WriteBucket(0, 0)
@@ -34,6 +35,12 @@ def test_writing(tmpdir):
 
     b.addpair((1, 2))
 
+    # Small buckets stay in memory until they are closed.
+    listdir = tmpdir.listdir()
+    assert listdir == []
+
+    b.close_writer(do_sync=False)
+
     filename = prefix + '.mrsb'
     path = tmpdir.join(filename).strpath
     listdir = tmpdir.listdir()
@@ -108,4 +115,34 @@ def test_roundtrip_write_only(tmpdir):
     listdir = tmpdir.listdir()
     assert listdir == []
 
+def test_collect_serialized(tmpdir):
+    b = WriteBucket(0, 3, dir=tmpdir.strpath, format=BinWriter)
+    dumps_key, _ = dumps_functions(None)
+    pairs = [(4, 'test'), (3, 'a'), (1, 'This'), (2, 'is')]
+    b.collect_serialized([(pair, dumps_key(pair[0])) for pair in pairs])
+
+    values = ' '.join(value for key, value in b)
+    assert values == 'test a This is'
+
+    b.close_writer(do_sync=False)
+    readonly_copy = b.readonly_copy()
+    assert list(readonly_copy.stream()) == pairs
+
+def test_spill(tmpdir):
+    b = WriteBucket(0, 1, dir=tmpdir.strpath, format=BinWriter)
+    value = 'x' * 1000
+    pairs = [(i, value) for i in range(200)]
+    b.collect(pairs, write_only=True)
+
+    # The data exceed the spill threshold, so the file already exists.
+    filename = b.prefix() + '.mrsb'
+    path = tmpdir.join(filename).strpath
+    listdir = tmpdir.listdir()
+    assert listdir == [path]
+
+    b.close_writer(do_sync=False)
+    readonly_copy = b.readonly_copy()
+    assert readonly_copy.url == path
+    assert list(readonly_copy.stream()) == pairs
+
 # vim: et sw=4 sts=4
@@ -12,6 +12,12 @@ def test_local_to_global_outside_dir():
     url = c.local_to_global('/other/path/xyz.txt')
     assert url == '/other/path/xyz.txt'
 
+def test_local_to_global_many():
+    c = URLConverter('myhost', 42, '/my/path')
+
+    urls = c.local_to_global_many(['/my/path/xyz.txt', '/other/path/xyz.txt'])
+    assert urls == ['http://myhost:42/xyz.txt', '/other/path/xyz.txt']
+
 def test_global_to_local():
     c = URLConverter('myhost', 42, '/my/path')
     master = 'server:8080'
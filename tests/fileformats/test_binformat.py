@@ -1,4 +1,4 @@
-from mrs.fileformats import BinReader, BinWriter
+from mrs.fileformats import BinReader, BinWriter, open_url
 from mrs.serializers import raw_serializer, Serializers
 
 try:
@@ -56,4 +56,22 @@ def test_pickle_roundtrip():
 
     assert new_pairs == kv_pairs
 
+def test_mapped_roundtrip(tmpdir):
+    kv_pairs = [(b'key 1', b'value 1'),
+            (b'long', b'x' * 10000),
+            (b'the', b'end')]
+    serializers = Serializers(raw_serializer, '', raw_serializer, '')
+
+    path = tmpdir.join('data.mrsb').strpath
+    with open(path, 'wb') as f:
+        writer = BinWriter(f, serializers=serializers)
+        for pair in kv_pairs:
+            writer.writepair(pair)
+        writer.finish()
+
+    with open_url(path, serializers=serializers) as reader:
+        new_pairs = list(reader)
+
+    assert new_pairs == kv_pairs
+
 # vim: et sw=4 sts=4
@@ -0,0 +1,53 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import mrs
+
+
+class LocalDataSum(mrs.MapReduce):
+    """Sum the integers 0 through 9 from a local_data dataset.
+
+    The local data are written to the output directory, so that the runner
+    gets only their urls.  The result is written to `result` in that
+    directory.
+    """
+
+    def map(self, key, value):
+        yield (0, value)
+
+    def reduce(self, key, values):
+        yield sum(values)
+
+    def run(self, job):
+        outdir = self.output_dir()
+        source = job.local_data(((i, i) for i in range(10)), splits=3,
+                outdir=outdir)
+        intermediate = job.map_data(source, self.map)
+        source.close()
+        output = job.reduce_data(intermediate, self.reduce, splits=1)
+        intermediate.close()
+
+        ready = []
+        while not ready:
+            ready = job.wait(output, timeout=2.0)
+        output.fetchall()
+        with open('%s/result' % outdir, 'w') as f:
+            for key, value in output.data():
+                print(key, value, file=f)
+        return 0
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,35 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mrs.test import run_serial, run_mockparallel, run_master_slave
+from .localdata import LocalDataSum
+
+
+def test_local_data_outdir(mrs_impl, tmpdir):
+    outdir = tmpdir.join('out')
+    args = [outdir.strpath]
+
+    if mrs_impl == 'serial':
+        run_serial(LocalDataSum, args)
+    elif mrs_impl == 'mockparallel':
+        run_mockparallel(LocalDataSum, args, tmpdir)
+    elif mrs_impl == 'master_slave':
+        run_master_slave(LocalDataSum, args, tmpdir)
+    else:
+        raise RuntimeError('Unknown mrs_impl: %s' % mrs_impl)
+
+    assert outdir.join('result').read() == '0 45\n'
+
+# vim: et sw=4 sts=4
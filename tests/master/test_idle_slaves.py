@@ -183,5 +183,31 @@ def test_add_to_smaller_host():
     assert slaves._max_count == 3
     slaves._consistency_check()
 
+def test_discard():
+    host1 = 'host1'
+    slave1 = Slave(host1, 'slave1')
+    slave2 = Slave(host1, 'slave2')
+
+    # Create a new slaves list.
+    slaves = IdleSlaves()
+
+    # Discarding an absent slave leaves the counts alone.
+    slaves.discard(slave1)
+    assert slaves._max_count == 0
+    slaves._consistency_check()
+
+    slaves.add(slave1)
+    slaves.add(slave2)
+    slaves.discard(slave1)
+    assert slave1 not in slaves
+    assert slaves._max_count == 1
+    slaves._consistency_check()
+    slaves.discard(slave1)
+    assert slaves._max_count == 1
+    slaves._consistency_check()
+    slaves.discard(slave2)
+    assert not slaves
+    slaves._consistency_check()
+
 
 # vim: et sw=4 sts=4
@@ -0,0 +1,93 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+from mrs import job
+from mrs.computed_data import ComputedData
+from mrs.runner import TaskRunner
+
+class Opts(object):
+    def __init__(self, sequential_datasets=False):
+        self.mrs__sequential_datasets = sequential_datasets
+
+class Dataset(object):
+    def __init__(self, dataset_id, ntasks=1):
+        self.id = dataset_id
+        self.ntasks = ntasks
+
+class Computed(ComputedData):
+    def __init__(self, dataset_id, input_id, ntasks):
+        self.id = dataset_id
+        self.input_id = input_id
+        self.ntasks = ntasks
+        self.serializers = None
+        self.closed = True
+
+class RecordingRunner(TaskRunner):
+    """Records the downstream task count of each dataset when computed."""
+    def compute_dataset(self, dataset):
+        self.computed.append((dataset.id, self._dependent_tasks(dataset.id)))
+
+def make_runner(sequential_datasets=False):
+    job_conn, _ = multiprocessing.Pipe()
+    runner = TaskRunner(None, Opts(sequential_datasets), [], job_conn,
+            None, None, None)
+
+    # Datasets a, b, c and d are submitted in that order.  The tasks that
+    # depend on them are: a: 1, b: 5, c: 1 + 5 (through c2), d: 1.
+    datasets = [Dataset('a'), Dataset('b'), Dataset('c'), Dataset('d'),
+            Dataset('a1', 1), Dataset('b1', 5), Dataset('c1', 1),
+            Dataset('c2', 5), Dataset('d1', 1)]
+    for ds in datasets:
+        runner.datasets[ds.id] = ds
+    for input_id, dep_id in [('a', 'a1'), ('b', 'b1'), ('c', 'c1'),
+            ('c1', 'c2'), ('d', 'd1')]:
+        runner.data_dependents[input_id].add(dep_id)
+    for seq, dataset_id in enumerate('abcd'):
+        runner._submit_seq[dataset_id] = seq
+    return runner
+
+def runnable_ids(runner):
+    return [ds.id for ds in runner.runnable_datasets]
+
+def test_dependent_tasks():
+    runner = make_runner()
+    assert runner._dependent_tasks('a') == 1
+    assert runner._dependent_tasks('b') == 5
+    assert runner._dependent_tasks('c') == 6
+    assert runner._dependent_tasks('d1') == 0
+
+def test_most_dependent_tasks_first():
+    runner = make_runner()
+    for dataset_id in 'dcba':
+        runner._make_runnable(runner.datasets[dataset_id])
+    # a and d tie, so they stay in submission order.
+    assert runnable_ids(runner) == ['c', 'b', 'a', 'd']
+
+def test_sequential_datasets():
+    runner = make_runner(sequential_datasets=True)
+    for dataset_id in 'dcba':
+        runner._make_runnable(runner.datasets[dataset_id])
+    assert runnable_ids(runner) == ['a', 'b', 'c', 'd']
+def test_batch_registered_before_computed():
+    job_conn, _ = multiprocessing.Pipe()
+    runner = RecordingRunner(None, Opts(), [], job_conn, None, None, None)
+    runner.computed = []
+    batch = job.DatasetSubmissionBatch([Computed('map', 'source', 3),
+        Computed('reduce', 'map', 4)])
+    runner._dispatch_job_message(batch)
+    assert runner.computed == [('map', 4), ('reduce', 0)]
+
+# vim: et sw=4 sts=4